@@ -0,0 +1,230 @@
+import argparse
+import json
+import os
+import resource
+import time
+from typing import Callable, Dict
+
+import numpy as np
+
+from src.ann_index import ANNIndex, HnswAnnIndex, QuantizedAnnIndex
+from src.config import TEXT_EMBEDDING_DIMENSION, MULTIMODAL_EMBEDDING_DIMENSION, THRESHOLD, HnswParams
+from src.utils import logger, setup_logging
+
+# ANNIndex implementations under test, by name; each factory gets
+# (initial capacity, dimension, HNSW params)
+INDEXES: Dict[str, Callable[[int, int, HnswParams], ANNIndex]] = {
+    "hnsw": lambda max_elements, dimension, params: HnswAnnIndex(max_elements, dimension, params=params),
+    "int8": lambda max_elements, dimension, params: QuantizedAnnIndex(max_elements, dimension, params=params),
+}
+
+
+def rss_bytes() -> int:
+    # current resident set size; falls back to the peak where /proc isn't available
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class SyntheticEmbeddings:
+    """
+    Clustered unit vectors, generated chunk by chunk from a seed so the
+    data set never has to be held in memory twice (once by the index, once
+    by the brute-force baseline). Real embeddings are clustered by topic,
+    which makes this closer to them than isotropic noise.
+    """
+    def __init__(self, n: int, dimension: int, clusters: int, spread: float, chunk_size: int, seed: int):
+        self.n = n
+        self.dimension = dimension
+        self.spread = spread
+        self.chunk_size = chunk_size
+        self.seed = seed
+        self.centers = np.random.default_rng([seed, 0]).normal(size=(clusters, dimension)).astype(np.float32)
+
+    def _sample(self, rng: np.random.Generator, n: int) -> np.ndarray:
+        centers = self.centers[rng.integers(len(self.centers), size=n)]
+        points = centers + self.spread * rng.normal(size=(n, self.dimension)).astype(np.float32)
+        return points / np.linalg.norm(points, axis=1, keepdims=True)
+
+    def chunks(self):
+        """
+        Yields (first id, points) covering ids 0..n-1.
+        """
+        for i, start in enumerate(range(0, self.n, self.chunk_size)):
+            rng = np.random.default_rng([self.seed, 1, i])
+            yield start, self._sample(rng, min(self.chunk_size, self.n - start))
+
+    def queries(self, n: int) -> np.ndarray:
+        # drawn from the same clusters but never inserted
+        return self._sample(np.random.default_rng([self.seed, 2]), n)
+
+
+def exact_top_k(data: SyntheticEmbeddings, queries: np.ndarray, k: int) -> np.ndarray:
+    """
+    Brute-force cosine top-k ids for each query, merged across data chunks.
+    """
+    best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+    best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+    for start, points in data.chunks():
+        sims = queries @ points.T
+        ids = np.broadcast_to(np.arange(start, start + len(points)), sims.shape)
+        all_sims = np.concatenate([best_sims, sims], axis=1)
+        all_ids = np.concatenate([best_ids, ids], axis=1)
+        top = np.argpartition(-all_sims, k - 1, axis=1)[:, :k]
+        best_sims = np.take_along_axis(all_sims, top, axis=1)
+        best_ids = np.take_along_axis(all_ids, top, axis=1)
+    return best_ids
+
+
+def build(index: ANNIndex, data: SyntheticEmbeddings, growth_factor: float) -> dict:
+    """
+    Insert everything, growing the index geometrically the way
+    EmbeddingCache does, and time inserts and resizes separately.
+    """
+    insert_seconds = 0.0
+    resizes = []
+    for start, points in data.chunks():
+        needed = index.get_curr_ct() + len(points)
+        if needed > index.get_max_elements():
+            new_size = max(int(index.get_max_elements() * growth_factor), needed)
+            t0 = time.perf_counter()
+            index.resize(new_size)
+            resizes.append(time.perf_counter() - t0)
+
+        t0 = time.perf_counter()
+        index.add_pts(points, list(range(start, start + len(points))))
+        insert_seconds += time.perf_counter() - t0
+
+    return {
+        "insert": {
+            "seconds": insert_seconds,
+            "points_per_sec": data.n / insert_seconds if insert_seconds else None,
+        },
+        "resize": {
+            "count": len(resizes),
+            "seconds": sum(resizes),
+            "max_seconds": max(resizes, default=0.0),
+        },
+    }
+
+
+def measure_search(index: ANNIndex, queries: np.ndarray, truth: np.ndarray, k: int, ef: int, rerank_factor: int) -> dict:
+    """
+    With rerank_factor > 1, also reports the recall after an exact re-rank
+    of the top k * rerank_factor candidates (as EmbeddingCache does for a
+    quantized index): a true neighbour anywhere in the candidates makes it
+    into the re-ranked top k, so that's the share of truth among them.
+    """
+    index.set_ef(ef)
+    latencies = []
+    found = 0
+    found_reranked = 0
+    for query, expected in zip(queries, truth):
+        t0 = time.perf_counter()
+        results = index.search_knn(query, k * rerank_factor)
+        latencies.append(time.perf_counter() - t0)
+        expected = set(expected.tolist())
+        found += len(expected.intersection(eid for eid, _ in results[:k]))
+        found_reranked += len(expected.intersection(eid for eid, _ in results))
+
+    latencies_ms = 1000 * np.asarray(latencies)
+    return {
+        "ef": ef,
+        "recall": found / truth.size,
+        # against exact float32 search, so this is the loss from approximation/quantization
+        "recall_loss": 1 - found / truth.size,
+        "recall_reranked": found_reranked / truth.size if rerank_factor > 1 else None,
+        "p50_ms": float(np.percentile(latencies_ms, 50)),
+        "p99_ms": float(np.percentile(latencies_ms, 99)),
+        "mean_ms": float(latencies_ms.mean()),
+    }
+
+
+def run(args: argparse.Namespace, index_name: str, dimension: int, n: int) -> dict:
+    logger.info(f"{index_name}: {n} points x {dimension} dims")
+    params = HnswParams(m=args.m, ef_construction=args.ef_construction)
+    data = SyntheticEmbeddings(n, dimension, args.clusters, args.spread, args.chunk_size, args.seed)
+    queries = data.queries(args.queries)
+
+    rss_before = rss_bytes()
+    index = INDEXES[index_name](args.initial_size, dimension, params)
+    result = build(index, data, args.growth_factor)
+    result["memory"] = {
+        "rss_delta_bytes": rss_bytes() - rss_before,
+        "raw_vector_bytes": n * dimension * 4,
+    }
+    logger.info(f"  inserted at {result['insert']['points_per_sec']:.0f} points/s, {result['resize']['count']} resizes")
+
+    t0 = time.perf_counter()
+    truth = exact_top_k(data, queries, args.k)
+    brute_force_ms = 1000 * (time.perf_counter() - t0) / len(queries)
+
+    searches = []
+    # a flat scan doesn't depend on ef
+    for ef in (args.ef[:1] if index.quantized else args.ef):
+        searches.append(measure_search(index, queries, truth, args.k, ef, args.rerank_factor))
+        s = searches[-1]
+        rerank = f" ({s['recall_reranked']:.3f} re-ranked)" if s["recall_reranked"] is not None else ""
+        logger.info(
+            f"  ef={ef}: recall@{args.k}={s['recall']:.3f}{rerank}, p50 {s['p50_ms']:.3f} ms, p99 {s['p99_ms']:.3f} ms"
+        )
+
+    return {
+        "index": index_name,
+        "dimension": dimension,
+        "n": n,
+        "k": args.k,
+        "m": args.m,
+        "ef_construction": args.ef_construction,
+        **result,
+        # batched over all queries, so a lower bound on single-query cost
+        "brute_force": {"ms_per_query": brute_force_ms},
+        "search": searches,
+    }
+
+
+def main():
+    defaults = HnswParams()
+    parser = argparse.ArgumentParser(
+        description="Recall/latency benchmark for the ANNIndex implementations on synthetic embeddings"
+    )
+    parser.add_argument("--index", nargs="+", default=list(INDEXES), choices=list(INDEXES))
+    parser.add_argument("--dims", nargs="+", type=int,
+                        default=[TEXT_EMBEDDING_DIMENSION, MULTIMODAL_EMBEDDING_DIMENSION])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--k", type=int, default=THRESHOLD)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--ef", nargs="+", type=int, default=[16, 32, 64, 128, 256])
+    parser.add_argument("--rerank-factor", type=int, default=1,
+                        help="also score an exact re-rank of k * this many candidates")
+    parser.add_argument("--m", type=int, default=defaults.m)
+    parser.add_argument("--ef-construction", type=int, default=defaults.ef_construction)
+    parser.add_argument("--initial-size", type=int, default=1000,
+                        help="starting capacity; the index grows by --growth-factor like EmbeddingCache")
+    parser.add_argument("--growth-factor", type=float, default=2.0)
+    parser.add_argument("--chunk-size", type=int, default=10_000, help="points generated and inserted per batch")
+    parser.add_argument("--clusters", type=int, default=1000)
+    parser.add_argument("--spread", type=float, default=1.0, help="noise around each cluster center")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="outputs/ann_benchmark.json")
+    parser.add_argument("--log-level", "--log", "-L", default="INFO")
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+
+    results = []
+    for index_name in args.index:
+        for dimension in args.dims:
+            for n in args.sizes:
+                results.append(run(args, index_name, dimension, n))
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump({"args": vars(args), "results": results}, f, indent=2)
+    logger.info(f"Wrote {len(results)} results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
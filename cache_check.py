@@ -0,0 +1,134 @@
+import argparse
+import threading
+import time
+from typing import Callable, Dict, List
+import numpy as np
+from src.ann_index import HnswAnnIndex, QuantizedAnnIndex
+from src.api import LLMInput
+from src.cache import CacheConfig, EmbeddingCache
+from src.cache_client import InMemoryCacheClient
+from src.config import EvictionPolicy, Modality
+from src.custom_types import EmbeddingData
+from src.utils import get_unix_seconds
+
+DIM = 16
+MODALITY = Modality.TEXT
+
+CHECKS: Dict[str, Callable[[], bool]] = {}
+
+
+def check(fn: Callable[[], bool]) -> Callable[[], bool]:
+    CHECKS[fn.__name__] = fn
+    return fn
+
+
+def make_cache(client: InMemoryCacheClient, **kwargs) -> EmbeddingCache:
+    # a worker of its own: separate index and L0, shared Redis
+    cfg = CacheConfig(client=client, ann_index=HnswAnnIndex(100, DIM), embedding_size=DIM, **kwargs)
+    return EmbeddingCache({MODALITY: cfg}, "check", cache_ttl=3600)
+
+
+def vectors(n: int, seed: int = 0) -> List[List[float]]:
+    return np.random.default_rng(seed).normal(size=(n, DIM)).tolist()
+
+
+def store(cache: EmbeddingCache, name: str, vector: List[float]) -> None:
+    cache.store_embedding(MODALITY, LLMInput(text=name), vector, f"answer-to-{name}")
+
+
+@check
+def clear_keeps_ids_unique() -> bool:
+    # a worker clears while another still has the old entries indexed;
+    # neither may then answer one prompt with another's response
+    client = InMemoryCacheClient()
+    a, b = make_cache(client), make_cache(client)
+    old, new = vectors(5, seed=1), vectors(5, seed=2)
+    for i, vec in enumerate(old):
+        store(a, f"z{i}", vec)
+    # loads b's index with the old entries
+    b.semantic_search(MODALITY, old[0], 1)
+
+    a.clear(MODALITY)
+    for i, vec in enumerate(new):
+        store(a, f"q{i}", vec)
+    store(b, "q5", vectors(1, seed=3)[0])
+
+    ok = True
+    for worker in (a, b):
+        worker.catch_up(MODALITY)
+        for vec in old:
+            # the old prompts are gone, so nothing may match them exactly
+            results = worker.semantic_search(MODALITY, vec, 1)
+            ok &= not results or results[0].similarity < 0.99
+        for i, vec in enumerate(new):
+            [hit] = worker.semantic_search(MODALITY, vec, 1)
+            ok &= hit.entry.response == f"answer-to-q{i}"
+    return ok
+
+
+@check
+def lfu_evicts_migrated_entries() -> bool:
+    # entries migrated from the JSON format start at an LFU count of 1 like
+    # new ones, so hit entries outlive them
+    client = InMemoryCacheClient()
+    cache = make_cache(client, max_entries=3, eviction_policy=EvictionPolicy.LFU)
+    for i, vec in enumerate(vectors(3, seed=4)):
+        legacy = EmbeddingData(id=i, query=f"old{i}", embedding=vec, response=f"answer-to-old{i}", timestamp=get_unix_seconds())
+        client.h_set(cache._redis_key(MODALITY), str(i), legacy.model_dump_json())
+    cache.migrate_embeddings(MODALITY)
+    # loads the index, as query's first search does
+    cache.semantic_search(MODALITY, vectors(1)[0], 1)
+
+    new = []
+    for i, vec in enumerate(vectors(3, seed=5)):
+        store(cache, f"new{i}", vec)
+        [hit] = cache.semantic_search(MODALITY, vec, 1)
+        cache.record_hit(MODALITY, hit.entry.id)
+        new.append(hit.entry.id)
+    survivors = sorted(int(i) for i in client.z_range(cache._usage_key(MODALITY), 0, -1))
+    return survivors == sorted(new)
+
+
+@check
+def writer_not_starved() -> bool:
+    # inserts get in between searches that keep the read lock busy
+    ok = True
+    for index in (HnswAnnIndex(20000, DIM), QuantizedAnnIndex(20000, DIM)):
+        index.add_pts(np.asarray(vectors(10000, seed=6), dtype=np.float32), list(range(10000)))
+        stop = threading.Event()
+        query = vectors(1, seed=7)[0]
+
+        def search():
+            while not stop.is_set():
+                index.search_with_pts(query, 10)
+
+        readers = [threading.Thread(target=search) for _ in range(4)]
+        for reader in readers:
+            reader.start()
+        time.sleep(0.1)
+        inserted = threading.Event()
+        writer = threading.Thread(target=lambda: (index.add_pt(query, 10000), inserted.set()))
+        writer.start()
+        ok &= inserted.wait(timeout=5)
+        stop.set()
+        for thread in (*readers, writer):
+            thread.join()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check EmbeddingCache behavior across workers sharing an in-process Redis stand-in"
+    )
+    parser.add_argument("checks", nargs="*", help="checks to run; all by default")
+    args = parser.parse_args()
+
+    results = {name: CHECKS[name]() for name in (args.checks or CHECKS)}
+    for name, ok in results.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    if not all(results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
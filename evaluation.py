@@ -1,91 +1,359 @@
 from src.config import *
-from src.ann_index import HnswAnnIndex
+from src.ann_index import new_ann_index
 from src.cache_client import RedisClient
 from src.cache import CacheConfig, EmbeddingCache
-from src.api import LLMInput, get_gpt_response
+from src.api import LLMInput, get_gpt_response, warmup, caption_cache
 from src.judge import SimilarityScorer
+from src.rate_limit import RateLimiter
+from src.utils import get_unix_seconds, hash_bytes, logger, setup_logging
 from main import query
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, List, Optional
+import argparse
+import json
+import random
+import threading
 import time
 
 from src.dataset import get_dataset
 
-def evaluate_flickr30k():
-    text_ann_index = HnswAnnIndex(1000, TEXT_EMBEDDING_DIMENSION)
-    text_client = RedisClient(REDIS_URL)
-    text_client.delete("embeddings:text")
+QUESTION = "Is this an appropriate caption for this image: "
+IMAGE_DIR = "flickr30k-images/"
+# the layout plots.py reads
+COLUMNS = [
+    "image_id", "caption1", "caption2", "is_cache_hit", "hits_first_record", "cache_llm_similarity",
+    "cache_embedding_similarity", "true_llm_similarity", "true_embedding_similarity", "latency",
+]
 
-    multimodal_ann_index = HnswAnnIndex(1000, MULTIMODAL_EMBEDDING_DIMENSION)
-    multimodal_client = RedisClient(REDIS_URL)
-    multimodal_client.delete("embeddings:multimodal")
 
+def _open_append(path: str):
+    """
+    Open `path` for appending, first cutting off a trailing partial line
+    left by a run that died mid-write.
+    """
+    if os.path.exists(path):
+        with open(path, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+    return open(path, "a")
+
+
+class ResponseStore:
+    """
+    LLM responses memoized by input and appended to a JSONL file, so each
+    is fetched once across all thresholds and survives a restart. Callers
+    asking for an input that's already being fetched wait for that call.
+    """
+    def __init__(self, path: str, fn: Callable[..., str], limiter: RateLimiter):
+        self.fn = fn
+        self.limiter = limiter
+        self._responses: Dict[str, str] = {}
+        # how long the call took, so a memoized answer can be timed like a live one
+        self._seconds: Dict[str, float] = {}
+        # inputs being fetched; other callers wait on the future
+        self._pending: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self._file = _open_append(path)
+        with open(path) as f:
+            for line in f:
+                row = json.loads(line)
+                self._responses[row["key"]] = row["response"]
+                self._seconds[row["key"]] = row["seconds"]
+
+    @staticmethod
+    def _key(llm_input: LLMInput) -> str:
+        return hash_bytes(json.dumps([llm_input.text, llm_input.image]).encode())
+
+    def seconds(self, llm_input: LLMInput) -> float:
+        with self._lock:
+            return self._seconds[self._key(llm_input)]
+
+    def __call__(self, llm_input: LLMInput, options: GPTOptions) -> str:
+        key = self._key(llm_input)
+        # a fetch stores its response and leaves _pending under the same
+        # lock, so every caller sees one or the other
+        with self._lock:
+            if key in self._responses:
+                return self._responses[key]
+            future = self._pending.get(key)
+            if future is None:
+                future = self._pending[key] = Future()
+                is_leader = True
+            else:
+                is_leader = False
+        if not is_leader:
+            return future.result()
+
+        try:
+            self.limiter.acquire()
+            start = time.perf_counter()
+            response = self.fn(llm_input=llm_input, options=options)
+            seconds = time.perf_counter() - start
+        except BaseException as e:
+            with self._lock:
+                del self._pending[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            self._responses[key] = response
+            self._seconds[key] = seconds
+            self._file.write(json.dumps({"key": key, "response": response, "seconds": seconds}) + "\n")
+            self._file.flush()
+            del self._pending[key]
+        future.set_result(response)
+        return response
+
+
+class Checkpoint:
+    """
+    One threshold's result rows, in the TSV layout plots.py reads. Rows are
+    flushed as they complete; images already in the file are skipped on
+    resume.
+    """
+    def __init__(self, path: str):
+        self._file = _open_append(path)
+        self._lock = threading.Lock()
+        with open(path) as f:
+            self.done = {line.split("\t", 1)[0] for line in f if line.count("\t") == len(COLUMNS) - 1}
+
+    def write(self, row: list) -> None:
+        with self._lock:
+            self._file.write("\t".join(map(str, row)) + "\n")
+            self._file.flush()
+
+
+def make_cache(prefix: str, text_client: RedisClient, multimodal_client: RedisClient, cache_ttl: int) -> EmbeddingCache:
+    # no snapshots: every threshold has its own index, and a resumed run
+    # rebuilds them from Redis
     configs = {
         Modality.TEXT: CacheConfig(
             client=text_client,
-            ann_index=text_ann_index,
-            embedding_size=TEXT_EMBEDDING_DIMENSION
+            ann_index=new_ann_index(ANN_INDEX_TYPE, 1000, TEXT_EMBEDDING_DIMENSION, params=hnsw_params(Modality.TEXT)),
+            embedding_size=TEXT_EMBEDDING_DIMENSION,
+            max_entries=MAX_CACHE_ENTRIES or None,
+            eviction_policy=EVICTION_POLICY,
+            quantize_vectors=QUANTIZE_VECTORS,
+            rerank_factor=RERANK_FACTOR,
         ),
         Modality.MULTIMODAL: CacheConfig(
             client=multimodal_client,
-            ann_index=multimodal_ann_index,
-            embedding_size=MULTIMODAL_EMBEDDING_DIMENSION
-        )
+            ann_index=new_ann_index(
+                ANN_INDEX_TYPE, 1000, MULTIMODAL_EMBEDDING_DIMENSION, params=hnsw_params(Modality.MULTIMODAL)
+            ),
+            embedding_size=MULTIMODAL_EMBEDDING_DIMENSION,
+            max_entries=MAX_CACHE_ENTRIES or None,
+            eviction_policy=EVICTION_POLICY,
+            quantize_vectors=QUANTIZE_VECTORS,
+            rerank_factor=RERANK_FACTOR,
+        ),
     }
-    
-    cache = EmbeddingCache(
-        configs=configs,
-        redis_key_prefix="embeddings",
-        cache_ttl=3600,
-    )
+    return EmbeddingCache(configs=configs, redis_key_prefix=prefix, cache_ttl=cache_ttl)
 
-    scorer = SimilarityScorer(gpt_opts, emb_opts)
 
-    dataset = get_dataset(num_return=50)
-    print("got dataset")
+def drop_unfinished(cache: EmbeddingCache, done: set) -> int:
+    """
+    Remove the entries stored for images without a completed row, e.g. the
+    ones in flight when an earlier run died, so a resumed run doesn't count
+    hits against them. Returns how many were removed.
+    """
+    stale = [
+        entry.id for entry in cache.get_all_embeddings(Modality.MULTIMODAL)
+        if entry.image.removeprefix(IMAGE_DIR) not in done
+    ]
+    cache.remove_entries(Modality.MULTIMODAL, stale)
+    return len(stale)
 
-    file = open("embedding.tsv", "w")
-    i = 0
-    for img in dataset:
-        print(i)
-        i += 1
 
-        captions = dataset[img]
-        if len(captions) < 2:
-            continue
+def evaluate_item(
+    img: str,
+    caption1: str,
+    caption2: str,
+    cache: EmbeddingCache,
+    sim_threshold: float,
+    answers: ResponseStore,
+    ground_truth: ResponseStore,
+    scorer: SimilarityScorer,
+) -> list:
+    image_path = IMAGE_DIR + img
+    first_llm_input = LLMInput(text=QUESTION + caption1, image=image_path)
+    second_llm_input = LLMInput(text=QUESTION + caption2, image=image_path)
 
-        #Creating Similar Inputs
-        caption1 = captions[0]
-        caption2 = captions[1]
-        question = "Is this an appropriate caption for this image: "
+    # no coalescing onto other items' in-flight misses: a follower would be
+    # recorded as a miss carrying another prompt's answer and wait time
+    first_output = query(llm_input=first_llm_input, gpt_opts=gpt_opts, emb_opts=emb_opts, cache=cache,
+                         threshold=THRESHOLD, sim_threshold=sim_threshold, coalesce_similar=False, llm=answers)
 
-        image_path = "flickr30k-images/" + img
-        
-        
-        first_llm_input = LLMInput(text=question + caption1, image=image_path)
-        second_llm_input = LLMInput(text=question + caption2, image=image_path)
+    llm_seconds = []
 
-        #Queries
-        first_output = query(llm_input=first_llm_input, gpt_opts=gpt_opts, emb_opts=emb_opts, cache=cache, threshold=THRESHOLD, sim_threshold=SIMILARITY_THRESHOLD)
+    def timed_answers(llm_input: LLMInput, options: GPTOptions) -> str:
+        start = time.perf_counter()
+        response = answers(llm_input=llm_input, options=options)
+        llm_seconds.append((llm_input, time.perf_counter() - start))
+        return response
 
-        start_time = time.time()
-        act_output = query(llm_input=second_llm_input, gpt_opts=gpt_opts, emb_opts=emb_opts, cache=cache, threshold=THRESHOLD, sim_threshold=SIMILARITY_THRESHOLD)
-        latency = time.time() - start_time
+    start_time = time.perf_counter()
+    act_output = query(llm_input=second_llm_input, gpt_opts=gpt_opts, emb_opts=emb_opts, cache=cache,
+                       threshold=THRESHOLD, sim_threshold=sim_threshold, coalesce_similar=False, llm=timed_answers)
+    latency = time.perf_counter() - start_time
+    # a miss may have been answered from the store (or waited on the rate
+    # limiter); count what the live LLM call took instead
+    for llm_input, seconds in llm_seconds:
+        latency += answers.seconds(llm_input) - seconds
 
-        exp_output = get_gpt_response(llm_input=second_llm_input, options=gpt_opts)
+    # asked separately from the cache's answers, as the reference
+    exp_output = ground_truth(llm_input=second_llm_input, options=gpt_opts)
 
-        #Metrics
-        cache_llm_score = scorer.similarity_score(first_output.text, exp_output)
-        cache_emb_score = scorer.embeddings_similarity(first_output.text, exp_output)
+    # the cached answer, then (if it differs) the one actually returned, against the reference
+    pairs = [(first_output.text, exp_output)]
+    if first_output.text != act_output.text:
+        pairs.append((act_output.text, exp_output))
+    llm_scores = scorer.similarity_scores(pairs)
+    emb_scores = scorer.embeddings_similarities(pairs)
+    cache_llm_score, true_llm_score = llm_scores[0], llm_scores[-1]
+    cache_emb_score, true_emb_score = emb_scores[0], emb_scores[-1]
 
-        if first_output.text != act_output.text:
-            true_llm_score = scorer.similarity_score(act_output.text, exp_output)
-            true_emb_score = scorer.embeddings_similarity(act_output.text, exp_output)
+    hit_first_input = act_output.is_hit and (first_llm_input.text == act_output.best_candidate.query)
+    return [img, caption1, caption2, act_output.is_hit, hit_first_input,
+            cache_llm_score, cache_emb_score, true_llm_score, true_emb_score, latency]
+
+
+def evaluate_flickr30k(
+    thresholds: Optional[List[float]] = None,
+    num_images: int = 50,
+    workers: int = 8,
+    requests_per_second: float = 0,
+    output_dir: str = "outputs",
+    fresh: bool = False,
+    seed: int = 0,
+    cache_ttl: int = 3600,
+    judge_pairs_per_request: int = JUDGE_PAIRS_PER_REQUEST,
+):
+    """
+    Ask each image's first two captions through a separate cache per
+    similarity threshold, writing one `embedding_{threshold}.tsv` per
+    threshold. LLM answers and ground-truth responses are shared between
+    thresholds and kept in `output_dir`, along with completed rows, so an
+    interrupted run picks up where it stopped (unless `fresh`).
+
+    A resumed threshold's cache keeps only what its completed rows stored.
+    Once `cache_ttl` has passed since the threshold started, some of those
+    entries may have expired while the run was down, so resuming is refused.
+    """
+    if thresholds is None:
+        thresholds = [SIMILARITY_THRESHOLD]
+    warmup(EMBEDDING_MODE)
+    os.makedirs(output_dir, exist_ok=True)
+
+    text_client = RedisClient(REDIS_URL)
+    multimodal_client = RedisClient(REDIS_URL)
+    caption_cache.attach(RedisClient(REDIS_URL))
+
+    paths = {t: os.path.join(output_dir, f"embedding_{t}.tsv") for t in thresholds}
+    answers_path = os.path.join(output_dir, "eval_answers.jsonl")
+    ground_truth_path = os.path.join(output_dir, "eval_ground_truth.jsonl")
+    # when each threshold's cache was started from empty
+    started_path = os.path.join(output_dir, "eval_started.json")
+    if fresh:
+        for path in [*paths.values(), answers_path, ground_truth_path, started_path]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    # every OpenAI request (answers, ground truth, judging) shares the limit
+    limiter = RateLimiter(requests_per_second, burst=workers)
+    answers = ResponseStore(answers_path, get_gpt_response, limiter)
+    ground_truth = ResponseStore(ground_truth_path, get_gpt_response, limiter)
+    scorer = SimilarityScorer(gpt_opts, emb_opts, pairs_per_request=judge_pairs_per_request, limiter=limiter)
+
+    checkpoints = {t: Checkpoint(path) for t, path in paths.items()}
+    started = {}
+    if os.path.exists(started_path):
+        with open(started_path) as f:
+            started = json.load(f)
+    now = get_unix_seconds()
+    for t in thresholds:
+        if checkpoints[t].done and cache_ttl and now - started.get(str(t), 0) >= cache_ttl:
+            raise RuntimeError(
+                f"Threshold {t} started over {cache_ttl}s ago and its cache entries may have expired; "
+                f"rerun with --fresh"
+            )
+
+    caches = {}
+    for t in thresholds:
+        caches[t] = make_cache(f"eval:{t}", text_client, multimodal_client, cache_ttl)
+        if checkpoints[t].done:
+            dropped = drop_unfinished(caches[t], checkpoints[t].done)
+            logger.info(f"Resuming threshold {t}: {len(checkpoints[t].done)} rows done, {dropped} stale entries dropped")
         else:
-            true_llm_score = cache_llm_score
-            true_emb_score = cache_emb_score
+            caches[t].clear(Modality.TEXT)
+            caches[t].clear(Modality.MULTIMODAL)
+            started[str(t)] = now
+    with open(started_path, "w") as f:
+        json.dump(started, f)
+
+    # the same sample on every resume
+    random.seed(seed)
+    dataset = get_dataset(num_return=num_images)
+    logger.info(f"Got {len(dataset)} images")
+
+    tasks = [
+        (img, t)
+        for img, captions in dataset.items() if len(captions) >= 2
+        for t in thresholds if img not in checkpoints[t].done
+    ]
+    logger.info(f"{len(tasks)} (image, threshold) pairs to evaluate")
+
+    def run_one(img: str, t: float) -> None:
+        captions = dataset[img]
+        row = evaluate_item(img, captions[0], captions[1], caches[t], t, answers, ground_truth, scorer)
+        checkpoints[t].write(row)
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {pool.submit(run_one, img, t): (img, t) for img, t in tasks}
+        failed = 0
+        for i, future in enumerate(as_completed(futures), 1):
+            img, t = futures[future]
+            try:
+                future.result()
+            except Exception:
+                # not checkpointed, so the next run retries it
+                failed += 1
+                logger.exception(f"Failed on {img} at threshold {t}")
+            logger.info(f"{i}/{len(tasks)} done ({failed} failed)")
+    except KeyboardInterrupt:
+        pool.shutdown(wait=False, cancel_futures=True)
+        raise
+    pool.shutdown()
 
-        hit_first_input = act_output.is_hit and (first_llm_input.text == act_output.best_candidate.query)
-        file.write(f"{img}\t{caption1}\t{caption2}\t{act_output.is_hit}\t{hit_first_input}\t{cache_llm_score}\t{cache_emb_score}\t{true_llm_score}\t{true_emb_score}\t{latency}\n")
-        file.flush()
 
 if __name__ == "__main__":
-    evaluate_flickr30k()
+    parser = argparse.ArgumentParser(description="Evaluate cache hit rate and answer quality on Flickr30k captions")
+    parser.add_argument("--thresholds", nargs="+", type=float, default=[SIMILARITY_THRESHOLD],
+                        help="similarity thresholds to sweep, each with its own cache")
+    parser.add_argument("--num-images", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=8, help="dataset items evaluated concurrently")
+    parser.add_argument("--requests-per-second", "--rps", type=float, default=0,
+                        help="cap on OpenAI requests per second; 0 for no cap")
+    parser.add_argument("--output-dir", default="outputs")
+    parser.add_argument("--fresh", action="store_true", help="discard earlier results and stored responses")
+    parser.add_argument("--seed", type=int, default=0, help="dataset sample; keep it fixed to resume")
+    parser.add_argument("--cache-ttl", type=int, default=3600)
+    parser.add_argument("--judge-pairs-per-request", type=int, default=JUDGE_PAIRS_PER_REQUEST,
+                        help="text pairs scored per judge request")
+    parser.add_argument("--log-level", "--log", "-L", default="INFO")
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+    evaluate_flickr30k(
+        thresholds=args.thresholds,
+        num_images=args.num_images,
+        workers=args.workers,
+        requests_per_second=args.requests_per_second,
+        output_dir=args.output_dir,
+        fresh=args.fresh,
+        seed=args.seed,
+        cache_ttl=args.cache_ttl,
+        judge_pairs_per_request=args.judge_pairs_per_request,
+    )
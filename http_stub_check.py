@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Local stand-in for the OpenAI API. Counts TCP connections and requests,
+    and answers the next queued status codes in `failures` with errors.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = 0
+        self.failures: list[int] = []
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+    def reset(self, failures: list[int] = ()) -> None:
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.failures = list(failures)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a pooled client reuses one connection
+    protocol_version = "HTTP/1.1"
+    server: StubServer
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.server.lock:
+            self.server.requests += 1
+            failure = self.server.failures.pop(0) if self.server.failures else None
+
+        if failure:
+            self._send(failure, {"error": {"message": "stub failure", "type": "server_error"}})
+        elif self.path.endswith("/embeddings"):
+            self._send(200, {
+                "object": "list",
+                "model": request["model"],
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": [1.0, 0.0, 0.0, 0.0]}
+                    for i in range(len(request["input"]))
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0},
+            })
+        elif self.path.endswith("/chat/completions"):
+            self._send(200, {
+                "id": "stub",
+                "object": "chat.completion",
+                "created": 0,
+                "model": request["model"],
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": "42.00;stub"},
+                    "finish_reason": "stop",
+                }],
+            })
+        else:
+            self._send(404, {"error": {"message": f"no stub for {self.path}"}})
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check the pooled HTTP clients in src/http_clients.py against a local stub OpenAI server"
+    )
+    parser.add_argument("--calls", type=int, default=20, help="sequential calls per keep-alive check")
+    args = parser.parse_args()
+
+    server = StubServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    # src.config reads these at import time
+    os.environ["OPENAI_BASE_URL"] = server.url
+    os.environ["HTTP_BACKOFF"] = "0"
+    import requests
+    from src.api import LLMInput, singlestep_get_embeddings
+    from src.config import HTTP_MAX_RETRIES, EmbeddingOptions, Provider
+    from src.http_clients import get_openai_client
+
+    opts = EmbeddingOptions(model="stub", provider=Provider.OPENAI, api_key="stub")
+    client = get_openai_client("stub")
+    results = {}
+
+    def embed():
+        return singlestep_get_embeddings([LLMInput(text="hello")], opts)
+
+    def chat():
+        return client.chat.completions.create(model="stub", messages=[{"role": "user", "content": "hi"}])
+
+    # every call after the first reuses the pooled connection
+    for name, call in (("embeddings_keep_alive", embed), ("chat_keep_alive", chat)):
+        server.reset()
+        for _ in range(args.calls):
+            call()
+        results[name] = server.requests == args.calls and server.connections == 1
+
+    # a transient 503 is retried and the call succeeds
+    for name, call in (("embeddings_retry", embed), ("chat_retry", chat)):
+        server.reset(failures=[503])
+        call()
+        results[name] = server.requests == 2
+
+    # once retries run out, the last response reaches raise_for_status
+    server.reset(failures=[500] * (HTTP_MAX_RETRIES + 1))
+    try:
+        embed()
+        results["embeddings_retries_exhausted"] = False
+    except requests.HTTPError as e:
+        results["embeddings_retries_exhausted"] = e.response.status_code == 500
+    except requests.RequestException:
+        results["embeddings_retries_exhausted"] = False
+
+    server.shutdown()
+    for name, ok in results.items():
+        print(f"{'ok  ' if ok else 'FAIL'} {name}")
+    if not all(results.values()):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
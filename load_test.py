@@ -0,0 +1,251 @@
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, List
+
+import numpy as np
+
+from main import query
+from src.ann_index import new_ann_index
+from src.api import LLMInput
+from src.cache import CacheConfig, EmbeddingCache
+from src.cache_client import CacheClient, InMemoryCacheClient, RedisClient
+from src.config import (
+    ANN_INDEX_TYPE, QUANTIZE_VECTORS, RERANK_FACTOR, SIMILARITY_THRESHOLD, TEXT_EMBEDDING_DIMENSION, THRESHOLD,
+    AnnIndexType, Modality, emb_opts, gpt_opts, hnsw_params,
+)
+from src.metrics import metrics
+from src.utils import hash_bytes, setup_logging
+
+
+class StubLLM:
+    """
+    Stands in for get_gpt_response: sleeps for `latency_ms` (+/- uniform
+    jitter) and echoes the prompt back.
+    """
+    def __init__(self, latency_ms: float, jitter_ms: float, seed: int):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.calls = 0
+        self._rng = np.random.default_rng(seed)
+        self._lock = threading.Lock()
+
+    def __call__(self, llm_input: LLMInput, options) -> str:
+        with self._lock:
+            self.calls += 1
+            jitter = self._rng.uniform(-self.jitter_ms, self.jitter_ms)
+        time.sleep(max(self.latency_ms + jitter, 0) / 1000)
+        return f"answer: {llm_input.text}"
+
+
+class FakeEmbedder:
+    """
+    Stands in for get_embedding with a deterministic bag-of-words embedding:
+    every word maps to a fixed random unit vector (seeded by its hash) and a
+    prompt embeds to their normalized sum. Prompts sharing most of their
+    words therefore land close together, as with a real sentence model.
+    """
+    def __init__(self, dimension: int, latency_ms: float):
+        self.dimension = dimension
+        self.latency_ms = latency_ms
+        self._words: Dict[str, np.ndarray] = {}
+
+    def _word(self, word: str) -> np.ndarray:
+        vec = self._words.get(word)
+        if vec is None:
+            seed = int(hash_bytes(word.encode())[:16], 16)
+            vec = np.random.default_rng(seed).normal(size=self.dimension).astype(np.float32)
+            vec /= np.linalg.norm(vec)
+            self._words[word] = vec
+        return vec
+
+    def __call__(self, llm_input: LLMInput, options) -> list:
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        emb = np.sum([self._word(w) for w in llm_input.text.casefold().split()], axis=0)
+        return [(emb / np.linalg.norm(emb)).tolist(), []]
+
+
+@dataclass
+class Sample:
+    kind: str
+    latency: float
+    is_hit: bool
+    coalesced: bool
+
+
+def make_workload(
+    n: int,
+    repeat_rate: float,
+    near_dup_rate: float,
+    prompt_words: int,
+    vocab_size: int,
+    seed: int,
+) -> List[tuple[str, str]]:
+    """
+    (kind, prompt) pairs: "repeat" re-sends an earlier prompt verbatim,
+    "near_dup" re-sends one with a single word replaced, "new" is fresh.
+    """
+    rng = np.random.default_rng(seed)
+    vocab = [f"w{i}" for i in range(vocab_size)]
+    seen: List[List[str]] = []
+    workload = []
+    for _ in range(n):
+        r = rng.random()
+        if seen and r < repeat_rate:
+            words = seen[rng.integers(len(seen))]
+            workload.append(("repeat", " ".join(words)))
+            continue
+        if seen and r < repeat_rate + near_dup_rate:
+            words = list(seen[rng.integers(len(seen))])
+            words[rng.integers(len(words))] = vocab[rng.integers(vocab_size)]
+            kind = "near_dup"
+        else:
+            words = [vocab[i] for i in rng.integers(vocab_size, size=prompt_words)]
+            kind = "new"
+        seen.append(words)
+        workload.append((kind, " ".join(words)))
+    return workload
+
+
+def percentiles(latencies: List[float]) -> dict:
+    if not latencies:
+        return {"count": 0}
+    ms = 1000 * np.asarray(latencies)
+    return {
+        "count": len(ms),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+        "mean_ms": float(ms.mean()),
+    }
+
+
+def report(samples: List[Sample], seconds: float, llm: StubLLM) -> dict:
+    hits = [s for s in samples if s.is_hit]
+    coalesced = [s for s in samples if s.coalesced]
+    misses = [s for s in samples if not s.is_hit and not s.coalesced]
+    by_kind = {}
+    for kind in sorted({s.kind for s in samples}):
+        of_kind = [s for s in samples if s.kind == kind]
+        by_kind[kind] = {
+            "count": len(of_kind),
+            "hit_rate": sum(s.is_hit for s in of_kind) / len(of_kind),
+        }
+
+    return {
+        "requests": len(samples),
+        "seconds": seconds,
+        "qps": len(samples) / seconds,
+        "hit_rate": len(hits) / len(samples),
+        "llm_calls": llm.calls,
+        "latency": {
+            "all": percentiles([s.latency for s in samples]),
+            "hit": percentiles([s.latency for s in hits]),
+            "miss": percentiles([s.latency for s in misses]),
+            # misses answered by another request's in-flight LLM call
+            "coalesced": percentiles([s.latency for s in coalesced]),
+        },
+        "by_kind": by_kind,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Closed-loop load test of main.query with a stub LLM, a fake embedder and an in-process cache"
+    )
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--repeat-rate", type=float, default=0.3)
+    parser.add_argument("--near-dup-rate", type=float, default=0.2)
+    parser.add_argument("--prompt-words", type=int, default=8,
+                        help="near-duplicates share all but one word, so cosine ~ (n-1)/n")
+    parser.add_argument("--vocab-size", type=int, default=5000)
+    parser.add_argument("--llm-latency-ms", type=float, default=500)
+    parser.add_argument("--llm-jitter-ms", type=float, default=100)
+    parser.add_argument("--embed-latency-ms", type=float, default=5)
+    parser.add_argument("--dimension", type=int, default=TEXT_EMBEDDING_DIMENSION)
+    parser.add_argument("--k", type=int, default=THRESHOLD)
+    parser.add_argument("--sim-threshold", type=float, default=SIMILARITY_THRESHOLD)
+    parser.add_argument("--index-type", type=AnnIndexType, default=ANN_INDEX_TYPE, choices=list(AnnIndexType))
+    parser.add_argument("--quantize-vectors", action="store_true", default=QUANTIZE_VECTORS)
+    parser.add_argument("--rerank-factor", type=int, default=RERANK_FACTOR)
+    parser.add_argument("--no-coalesce", action="store_true", help="don't merge similar in-flight misses")
+    parser.add_argument("--redis-url", help="use this Redis instead of the in-process client")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="outputs/load_test.json")
+    parser.add_argument("--log-level", "--log", "-L", default="WARNING")
+    args = parser.parse_args()
+
+    setup_logging(args.log_level)
+
+    client: CacheClient = RedisClient(args.redis_url) if args.redis_url else InMemoryCacheClient()
+    cache = EmbeddingCache(
+        configs={
+            Modality.TEXT: CacheConfig(
+                client=client,
+                ann_index=new_ann_index(args.index_type, 1000, args.dimension, params=hnsw_params(Modality.TEXT)),
+                embedding_size=args.dimension,
+                quantize_vectors=args.quantize_vectors,
+                rerank_factor=args.rerank_factor,
+            ),
+        },
+        # a fresh namespace, so a shared Redis isn't disturbed
+        redis_key_prefix=f"loadtest:{uuid.uuid4().hex[:8]}",
+        cache_ttl=3600,
+    )
+    llm = StubLLM(args.llm_latency_ms, args.llm_jitter_ms, args.seed)
+    embedder = FakeEmbedder(args.dimension, args.embed_latency_ms)
+    workload = make_workload(
+        args.requests, args.repeat_rate, args.near_dup_rate, args.prompt_words, args.vocab_size, args.seed
+    )
+
+    def run_one(kind: str, prompt: str) -> Sample:
+        start = time.perf_counter()
+        out = query(
+            llm_input=LLMInput(text=prompt),
+            gpt_opts=gpt_opts,
+            emb_opts=emb_opts,
+            cache=cache,
+            threshold=args.k,
+            sim_threshold=args.sim_threshold,
+            coalesce_similar=not args.no_coalesce,
+            llm=llm,
+            embedder=embedder,
+        )
+        return Sample(kind, time.perf_counter() - start, out.is_hit, out.coalesced)
+
+    try:
+        start = time.perf_counter()
+        # at most `concurrency` queries in flight; each worker picks up the
+        # next request as soon as its previous one returns
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            samples = list(pool.map(lambda item: run_one(*item), workload))
+        seconds = time.perf_counter() - start
+    finally:
+        if args.redis_url:
+            cache.clear(Modality.TEXT)
+
+    result = {"args": {**vars(args), "index_type": args.index_type.value}, **report(samples, seconds, llm)}
+    if metrics.enabled:
+        # per-stage histograms and counters from the instrumented query path
+        result["metrics"] = metrics.snapshot()
+    lat = result["latency"]
+    print(
+        f"{result['qps']:.1f} QPS, hit rate {result['hit_rate']:.1%}, {llm.calls} LLM calls; "
+        f"p50/p99 hit {lat['hit'].get('p50_ms', 0):.1f}/{lat['hit'].get('p99_ms', 0):.1f} ms, "
+        f"miss {lat['miss'].get('p50_ms', 0):.1f}/{lat['miss'].get('p99_ms', 0):.1f} ms"
+    )
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,53 @@
 import argparse
+import asyncio
+import functools
+from concurrent.futures import Executor
 from time import sleep
-from typing import Optional
+from typing import Callable, Optional
 
 from PIL import Image
 
-from src.api import get_embedding, get_gpt_response, LLMInput, LLMOutput, twostep_get_embedding
+from src.api import get_embedding, get_gpt_response, LLMInput, LLMOutput, twostep_get_embedding, warmup, caption_cache
+from src.api import aget_embedding, aget_gpt_response
 from src.config import *
-from src.ann_index import HnswAnnIndex
+from src.ann_index import new_ann_index
 from src.cache_client import RedisClient
 from src.cache import CacheConfig, EmbeddingCache
 from src.api import GPTOptions, EmbeddingOptions, Provider, get_embedding, get_gpt_response
-from src.similarity import cosine_similarity
+from src.metrics import metrics
 from src.utils import logger, setup_logging
 import time
 
+
+def _finish(output: LLMOutput, timings: dict) -> LLMOutput:
+    output.timings = timings
+    metrics.inc("hits" if output.is_hit else "coalesced" if output.coalesced else "misses")
+    return output
+
+
+def _traced(fn):
+    """
+    Run a query under metrics.trace(), attach its stage timings to the
+    returned LLMOutput and count it as a hit, miss or coalesced miss.
+    """
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        with metrics.trace() as timings:
+            output = fn(*args, **kwargs)
+        return _finish(output, timings)
+    return wrapper
+
+
+def _atraced(fn):
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        with metrics.trace() as timings:
+            output = await fn(*args, **kwargs)
+        return _finish(output, timings)
+    return wrapper
+
+
+@_traced
 def query(
     llm_input: LLMInput,
     gpt_opts: GPTOptions,
@@ -21,8 +55,16 @@ def query(
     cache: EmbeddingCache,
     threshold: int = 5,
     sim_threshold: float = 0.8,
+    coalesce_similar: bool = True,
+    llm: Optional[Callable[..., str]] = None,
+    embedder: Optional[Callable[..., list]] = None,
 ) -> LLMOutput:
-    
+    """
+    `llm` and `embedder` replace get_gpt_response / get_embedding (same
+    keyword arguments), e.g. with local stand-ins for load testing.
+    """
+    llm = llm or get_gpt_response
+    embedder = embedder or get_embedding
     prompt = llm_input.text
     output = LLMOutput()
 
@@ -33,70 +75,193 @@ def query(
     else:
         logger.info(f"Querying for {prompt}")
 
-    text_emb, img_emb = get_embedding(llm_input=llm_input, options=emb_opts)
-    emb = [*text_emb, *img_emb]
+    # hashes the image file, so it's computed once for the L0 lookup,
+    # in-flight dedup and the store
+    key = cache.exact_key(modality=modality, llm_input=llm_input)
+    exact = cache.lookup_exact(modality=modality, llm_input=llm_input, key=key)
+    if exact is not None:
+        logger.debug(f"Exact match: {exact.query} ({exact.response})")
+        # L0 hits stay local; the usage update goes out with a later write
+        cache.record_hit(modality=modality, eid=exact.id, defer=True)
+        output.text = exact.response
+        output.is_hit = True
+        output.best_candidate = exact
+        return output
 
-    candidates = cache.semantic_search(modality=modality, embedding=emb, k=threshold)
-    
+    # an identical miss is already waiting on the LLM, skip the embedding too
+    pending = cache.inflight.find(key)
+    if pending is not None:
+        logger.debug("Waiting on identical in-flight query")
+        output.text = pending.wait()
+        output.coalesced = True
+        return output
 
-    def red(c):
-        x, y = cosine_similarity(modality, emb, c.embedding)
-        return x**2 + y**2
+    text_emb, img_emb = embedder(llm_input=llm_input, options=emb_opts)
+    emb = [*text_emb, *img_emb]
 
-    def cmp(c):
-        text_score, image_score = cosine_similarity(modality, a=emb, b=c.embedding)
-        return text_score > sim_threshold and image_score > sim_threshold
+    # candidates come back scored against the index's own vectors, nothing to refetch
+    candidates = cache.semantic_search(modality=modality, embedding=emb, k=threshold)
+    candidates = [
+        c for c in candidates
+        if c.text_score > sim_threshold and c.image_score > sim_threshold
+    ]
 
-    candidates = list(filter(cmp, candidates))
-    
     if not candidates:
+        call, is_leader = cache.inflight.join(
+            key, modality, emb, sim_threshold=sim_threshold if coalesce_similar else None
+        )
+        if not is_leader:
+            logger.debug("No match found, waiting on in-flight query")
+            output.text = call.wait()
+            output.coalesced = True
+            return output
+
         logger.debug("No match found, querying LLM")
-        resp = get_gpt_response(llm_input=llm_input, options=gpt_opts)
-        cache.store_embedding(modality=modality, llm_input=llm_input, embedding=emb, response=resp)
+        try:
+            with metrics.stage("llm"):
+                resp = llm(llm_input=llm_input, options=gpt_opts)
+            logger.info("Got response from LLM")
+            cache.store_embedding(
+                modality=modality, llm_input=llm_input, embedding=emb, response=resp, exact_key=key
+            )
+        except BaseException as e:
+            cache.inflight.finish(key, error=e)
+            raise
+        cache.inflight.finish(key, result=resp)
 
         output.text = resp
         return output
-    
-    best = max(candidates, key=red)
-    text_score, image_score = cosine_similarity(modality, a=emb, b=best.embedding)
-    
-    logger.debug(f"Best match ({text_score}, {image_score}): {best.query} ({best.response})")
-    if text_score > sim_threshold and image_score > sim_threshold:
-        output.text = best.response
+
+    best = max(candidates, key=lambda c: c.text_score**2 + c.image_score**2)
+
+    logger.debug(f"Best match ({best.text_score}, {best.image_score}): {best.entry.query} ({best.entry.response})")
+    cache.record_hit(modality=modality, eid=best.entry.id)
+    output.text = best.entry.response
+    output.is_hit = True
+    output.best_candidate = best.entry
+
+    return output
+
+
+@_atraced
+async def aquery(
+    llm_input: LLMInput,
+    gpt_opts: GPTOptions,
+    emb_opts: EmbeddingOptions,
+    cache: EmbeddingCache,
+    threshold: int = 5,
+    sim_threshold: float = 0.8,
+    coalesce_similar: bool = True,
+    executor: Optional[Executor] = None,
+) -> LLMOutput:
+    """
+    asyncio version of `query`. Embedding runs on `executor`, Redis and the
+    LLM are awaited, so many queries can be in flight on one event loop.
+    The cache's configs need an async_client.
+    """
+    prompt = llm_input.text
+    output = LLMOutput()
+
+    modality = Modality.MULTIMODAL if llm_input.image != "" else Modality.TEXT
+    logger.info(f"Querying (async) for {prompt}")
+
+    key = cache.exact_key(modality=modality, llm_input=llm_input)
+    exact = cache.lookup_exact(modality=modality, llm_input=llm_input, key=key)
+    if exact is not None:
+        logger.debug(f"Exact match: {exact.query} ({exact.response})")
+        await cache.arecord_hit(modality=modality, eid=exact.id, defer=True)
+        output.text = exact.response
         output.is_hit = True
-        output.best_candidate = best
+        output.best_candidate = exact
+        return output
 
+    pending = cache.inflight.find(key)
+    if pending is not None:
+        logger.debug("Waiting on identical in-flight query")
+        output.text = await pending.await_result()
+        output.coalesced = True
         return output
-    
-    logger.debug("No good match found, querying LLM")
-    resp = get_gpt_response(llm_input=llm_input, options=gpt_opts)
-    logger.info("Got response from LLM")
-    cache.store_embedding(modality=modality, llm_input=llm_input, embedding=emb, response=resp)
 
-    output.text = resp
+    text_emb, img_emb = await aget_embedding(llm_input=llm_input, options=emb_opts, executor=executor)
+    emb = [*text_emb, *img_emb]
+
+    candidates = await cache.asemantic_search(modality=modality, embedding=emb, k=threshold)
+    candidates = [
+        c for c in candidates
+        if c.text_score > sim_threshold and c.image_score > sim_threshold
+    ]
+
+    if not candidates:
+        call, is_leader = cache.inflight.join(
+            key, modality, emb, sim_threshold=sim_threshold if coalesce_similar else None
+        )
+        if not is_leader:
+            logger.debug("No match found, waiting on in-flight query")
+            output.text = await call.await_result()
+            output.coalesced = True
+            return output
+
+        logger.debug("No match found, querying LLM")
+        try:
+            with metrics.stage("llm"):
+                resp = await aget_gpt_response(llm_input=llm_input, options=gpt_opts)
+            logger.info("Got response from LLM")
+            await cache.astore_embedding(
+                modality=modality, llm_input=llm_input, embedding=emb, response=resp, exact_key=key
+            )
+        except BaseException as e:
+            # followers get an error, not our cancellation, which would cancel them too
+            if isinstance(e, asyncio.CancelledError):
+                e = RuntimeError("In-flight LLM call was cancelled")
+            cache.inflight.finish(key, error=e)
+            raise
+        cache.inflight.finish(key, result=resp)
+
+        output.text = resp
+        return output
+
+    best = max(candidates, key=lambda c: c.text_score**2 + c.image_score**2)
+
+    logger.debug(f"Best match ({best.text_score}, {best.image_score}): {best.entry.query} ({best.entry.response})")
+    await cache.arecord_hit(modality=modality, eid=best.entry.id)
+    output.text = best.entry.response
+    output.is_hit = True
+    output.best_candidate = best.entry
+
     return output
 
 
 def repl():
+    warmup(EMBEDDING_MODE)
 
-    text_ann_index = HnswAnnIndex(1000, TEXT_EMBEDDING_DIMENSION)
+    text_ann_index = new_ann_index(ANN_INDEX_TYPE, 1000, TEXT_EMBEDDING_DIMENSION, params=hnsw_params(Modality.TEXT))
     text_client = RedisClient(REDIS_URL)
-    text_client.delete("embeddings:text")
 
-    multimodal_ann_index = HnswAnnIndex(1000, MULTIMODAL_EMBEDDING_DIMENSION)
+    multimodal_ann_index = new_ann_index(ANN_INDEX_TYPE, 1000, MULTIMODAL_EMBEDDING_DIMENSION, params=hnsw_params(Modality.MULTIMODAL))
     multimodal_client = RedisClient(REDIS_URL)
-    multimodal_client.delete("embeddings:multimodal")
+
+    caption_cache.attach(RedisClient(REDIS_URL))
 
     configs = {
         Modality.TEXT: CacheConfig(
             client=text_client,
             ann_index=text_ann_index,
-            embedding_size=TEXT_EMBEDDING_DIMENSION
+            embedding_size=TEXT_EMBEDDING_DIMENSION,
+            snapshot_path=snapshot_path(Modality.TEXT),
+            max_entries=MAX_CACHE_ENTRIES or None,
+            eviction_policy=EVICTION_POLICY,
+            quantize_vectors=QUANTIZE_VECTORS,
+            rerank_factor=RERANK_FACTOR,
         ),
         Modality.MULTIMODAL: CacheConfig(
             client=multimodal_client,
             ann_index=multimodal_ann_index,
-            embedding_size=MULTIMODAL_EMBEDDING_DIMENSION
+            embedding_size=MULTIMODAL_EMBEDDING_DIMENSION,
+            snapshot_path=snapshot_path(Modality.MULTIMODAL),
+            max_entries=MAX_CACHE_ENTRIES or None,
+            eviction_policy=EVICTION_POLICY,
+            quantize_vectors=QUANTIZE_VECTORS,
+            rerank_factor=RERANK_FACTOR,
         )
     }
     
@@ -105,16 +270,28 @@ def repl():
         redis_key_prefix="embeddings",
         cache_ttl=3600,
     )
+    # with snapshots enabled the cache is meant to outlive the process
+    if not SNAPSHOT_DIR:
+        cache.clear(Modality.TEXT)
+        cache.clear(Modality.MULTIMODAL)
 
     while True:
-        text = input("Enter text prompt: ")
-        image_path = input("Enter image path: ")
+        try:
+            text = input("Enter text prompt: ")
+            image_path = input("Enter image path: ")
+        except (EOFError, KeyboardInterrupt):
+            cache.save_snapshot(Modality.TEXT)
+            cache.save_snapshot(Modality.MULTIMODAL)
+            if metrics.enabled:
+                logger.info(f"Metrics: {metrics.snapshot()}")
+            return
 
         llm_input = LLMInput(text=text, image=image_path)
         
         start_time = time.time()
         resp = query(llm_input=llm_input, gpt_opts=gpt_opts, emb_opts=emb_opts, cache=cache, threshold=THRESHOLD, sim_threshold=SIMILARITY_THRESHOLD)
         latency = time.time() - start_time
+        logger.debug(f"Query took {latency:.3f}s: {resp.timings}")
 
         # print(f"Response: {resp}")
         # print(f"Query latency: {latency:.3f} seconds")
@@ -1,9 +1,36 @@
 from abc import ABC, abstractmethod
+from dataclasses import replace
 import hnswlib
-from typing import List, Tuple
+import json
+import numpy as np
+import os
+from typing import List, Optional, Tuple
+from .config import AnnIndexType, HnswParams
+from .embedding_codec import dequantize_int8, quantize_int8
+from .rwlock import RWLock
+from .similarity import normalize_rows
+from .utils import logger
 
 
 class ANNIndex(ABC):
+    """
+    Implementations are safe to share between threads: reads (search_knn,
+    get_pts, contains, get_curr_ct) run concurrently, writes are serialized
+    and exclude reads, and a rebuild (init_index, load) swaps the new graph
+    in atomically. `lock` is that read/write lock. It isn't reentrant, so
+    public methods never run under it; reads that must see the same index
+    go through one method, like `search_with_pts`, built on the unlocked
+    `_curr_ct` / `_search_knn` / `_get_pts`.
+    """
+    lock: RWLock
+
+    # whether get_pts returns unit-length vectors
+    normalized: bool = False
+    # whether stored vectors are lossy, so results are worth re-ranking
+    quantized: bool = False
+    # recorded in snapshots, which only load into the same kind of index
+    index_type: AnnIndexType
+
     @abstractmethod
     def init_index(self, max_elements: int, dimension: int) -> None:
         ...
@@ -12,8 +39,25 @@ class ANNIndex(ABC):
     def add_pt(self, point: List[float], id: int) -> None:
         ...
 
+    @abstractmethod
+    def add_pts(self, points: np.ndarray, ids: List[int]) -> None:
+        """
+        Insert a (n, dimension) matrix of points in one call.
+        """
+        ...
+
+    @abstractmethod
+    def mark_deleted(self, id: int) -> None:
+        """
+        Drop `id` from search results. Unknown or already deleted ids are ignored.
+        """
+        ...
+
     @abstractmethod
     def get_curr_ct(self) -> int:
+        """
+        Number of live (not deleted) points.
+        """
         ...
 
     @abstractmethod
@@ -28,48 +72,456 @@ class ANNIndex(ABC):
     def search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
         ...
 
+    @abstractmethod
+    def get_pts(self, ids: List[int]) -> np.ndarray:
+        ...
+
+    @abstractmethod
+    def _curr_ct(self) -> int:
+        # get_curr_ct, for callers already holding the lock
+        ...
+
+    @abstractmethod
+    def _search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
+        ...
+
+    @abstractmethod
+    def _get_pts(self, ids: List[int]) -> np.ndarray:
+        ...
+
+    def search_with_pts(self, query: List[float], k: int) -> Tuple[List[Tuple[int, float]], Optional[np.ndarray]]:
+        """
+        `search_knn` plus the matched points, under one read lock so a
+        concurrent delete can't free a slot between the two. An empty index
+        gives ([], None).
+        """
+        with self.lock.read():
+            curr = self._curr_ct()
+            if curr == 0:
+                return [], None
+            results = self._search_knn(query, min(k, curr))
+            return results, self._get_pts([r[0] for r in results])
+
+    @abstractmethod
+    def contains(self, id: int) -> bool:
+        ...
+
+    @abstractmethod
+    def get_ids(self) -> List[int]:
+        """
+        Ids of all live (not deleted) points.
+        """
+        ...
+
+    @abstractmethod
+    def set_ef(self, ef: int) -> None:
+        """
+        Query-time search breadth: higher is slower but finds more of the
+        true nearest neighbours.
+        """
+        ...
+
+    @abstractmethod
+    def get_ef(self) -> int:
+        ...
+
+    @abstractmethod
+    def save(self, path: str, log_cursor: str) -> None:
+        """
+        Persist the index to `path`, tagged with the insert log entry it is
+        up to date with.
+        """
+        ...
+
+    @abstractmethod
+    def load(self, path: str) -> Optional[str]:
+        """
+        Replace the index with the snapshot at `path` and return its log
+        cursor, or None if there is no usable snapshot.
+        """
+        ...
+
 
 class HnswAnnIndex(ANNIndex):
-    def __init__(self, max_elements: int, dimension: int):
+    # the cosine space normalizes vectors on insert
+    normalized = True
+    index_type = AnnIndexType.HNSW
+
+    def __init__(
+        self,
+        max_elements: int,
+        dimension: int,
+        num_threads: int = -1,
+        params: Optional[HnswParams] = None,
+    ):
         self.dimension = dimension
         self.max_elements = max_elements
-        self.points: List[Tuple[List[float], int]] = []
-        self._init_hnsw()
+        # copied, set_ef updates it
+        self.params = replace(params) if params else HnswParams()
+        # threads used by bulk inserts; -1 means all cores
+        self.num_threads = num_threads
+        # deleted slots are reused by later inserts
+        self.deleted_ct = 0
+        self.lock = RWLock()
+        self.index = self._new_hnsw(max_elements, dimension)
 
-    def _init_hnsw(self):
-        # import pdb; pdb.set_trace()
-        self.index = hnswlib.Index(space='cosine', dim=self.dimension)
-        # M=16, ef_construction=100 are defaults you can tune
-        self.index.init_index(max_elements=self.max_elements, ef_construction=100, M=16)
+    def _new_hnsw(self, max_elements: int, dimension: int) -> hnswlib.Index:
+        index = hnswlib.Index(space='cosine', dim=dimension)
+        index.init_index(
+            max_elements=max_elements,
+            ef_construction=self.params.ef_construction,
+            M=self.params.m,
+            allow_replace_deleted=True,
+        )
+        index.set_ef(self.params.ef)
+        return index
 
     def init_index(self, max_elements: int, dimension: int) -> None:
-        self.dimension = dimension
-        self.max_elements = max_elements
-        self.points.clear()
-        self._init_hnsw()
+        # build outside the lock, searches keep using the old graph until the swap
+        index = self._new_hnsw(max_elements, dimension)
+        with self.lock.write():
+            self.index = index
+            self.dimension = dimension
+            self.max_elements = max_elements
+            self.deleted_ct = 0
 
     def add_pt(self, point: List[float], id: int) -> None:
         if len(point) != self.dimension:
             raise ValueError("Point dimensions don't match!")
-        self.index.add_items(point, ids=[id])
-        self.points.append((point, id))
+        with self.lock.write():
+            self.index.add_items(point, ids=[id], replace_deleted=True)
+            self.deleted_ct = max(0, self.deleted_ct - 1)
+
+    def add_pts(self, points: np.ndarray, ids: List[int]) -> None:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, self.dimension)
+        if len(points) != len(ids):
+            raise ValueError("Number of points and ids don't match!")
+        if len(ids) == 0:
+            return
+        with self.lock.write():
+            self.index.add_items(points, ids=ids, num_threads=self.num_threads, replace_deleted=True)
+            self.deleted_ct = max(0, self.deleted_ct - len(ids))
+
+    def mark_deleted(self, id: int) -> None:
+        with self.lock.write():
+            try:
+                self.index.mark_deleted(id)
+            except RuntimeError:
+                # not in the index, or already deleted
+                return
+            self.deleted_ct += 1
 
     def get_curr_ct(self) -> int:
-        return self.index.get_current_count()
+        with self.lock.read():
+            return self._curr_ct()
+
+    def _curr_ct(self) -> int:
+        return self.index.get_current_count() - self.deleted_ct
 
     def get_max_elements(self) -> int:
         return self.max_elements
 
     def resize(self, new_size: int) -> None:
-        # Rebuild a larger index
-        old_points = list(self.points)
-        self.max_elements = new_size
-        self._init_hnsw()
-        for pt, pid in old_points:
-            self.index.add_items(pt, ids=[pid])
-        self.points = old_points
+        # grows the existing graph in place, nothing is re-inserted; hnswlib
+        # reallocates its buffers here, so no search may run meanwhile
+        with self.lock.write():
+            self.index.resize_index(new_size)
+            self.max_elements = new_size
 
     def search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
+        with self.lock.read():
+            return self._search_knn(query, k)
+
+    def _search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
         labels, distances = self.index.knn_query(query, k=k)
         # hnswlib returns lists of arrays
         return list(zip(labels[0].tolist(), distances[0].tolist()))
+
+    def get_pts(self, ids: List[int]) -> np.ndarray:
+        with self.lock.read():
+            return self._get_pts(ids)
+
+    def _get_pts(self, ids: List[int]) -> np.ndarray:
+        return np.asarray(self.index.get_items(ids, return_type="numpy"))
+
+    def contains(self, id: int) -> bool:
+        with self.lock.read():
+            try:
+                self.index.get_items([id])
+            except RuntimeError:
+                return False
+        return True
+
+    def get_ids(self) -> List[int]:
+        with self.lock.read():
+            ids = []
+            # get_ids_list includes deleted labels, which get_items rejects
+            for id in self.index.get_ids_list():
+                try:
+                    self.index.get_items([id])
+                except RuntimeError:
+                    continue
+                ids.append(id)
+        return ids
+
+    def set_ef(self, ef: int) -> None:
+        with self.lock.write():
+            self.index.set_ef(ef)
+            self.params.ef = ef
+
+    def get_ef(self) -> int:
+        return self.params.ef
+
+    def save(self, path: str, log_cursor: str) -> None:
+        # write both files under temp names first, so a crash mid-save
+        # leaves the previous snapshot intact; writers wait until the graph
+        # is on disk so it matches the metadata
+        with self.lock.read():
+            meta = {
+                "index_type": self.index_type.value,
+                "dimension": self.dimension,
+                "max_elements": self.max_elements,
+                "log_cursor": log_cursor,
+                "deleted": self.deleted_ct,
+            }
+            self.index.save_index(path + ".tmp")
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def load(self, path: str) -> Optional[str]:
+        if not (os.path.exists(path) and os.path.exists(path + ".json")):
+            return None
+
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if meta.get("index_type") != self.index_type.value:
+            logger.warning(f"Ignoring snapshot {path}: index type {meta.get('index_type')} != {self.index_type.value}")
+            return None
+        if meta["dimension"] != self.dimension:
+            logger.warning(f"Ignoring snapshot {path}: dimension {meta['dimension']} != {self.dimension}")
+            return None
+        if "log_cursor" not in meta:
+            # older snapshots carry an id watermark, which can't be replayed from
+            logger.warning(f"Ignoring snapshot {path}: no log cursor")
+            return None
+
+        max_elements = max(meta["max_elements"], self.max_elements)
+        index = hnswlib.Index(space='cosine', dim=self.dimension)
+        index.load_index(path, max_elements=max_elements, allow_replace_deleted=True)
+        # ef isn't part of the saved graph
+        index.set_ef(self.params.ef)
+        with self.lock.write():
+            self.index = index
+            self.max_elements = max_elements
+            self.deleted_ct = meta.get("deleted", 0)
+        return meta["log_cursor"]
+
+
+class QuantizedAnnIndex(ANNIndex):
+    """
+    Exact (flat) search over int8 scalar-quantized vectors: a quarter of the
+    memory of a float32 index, at the cost of some precision and an O(N)
+    scan of every row per query. The scan holds the read lock throughout,
+    so an insert or removal waits for the scans already running (new ones
+    queue behind it); with many entries, prefer the HNSW index. Meant to be
+    paired with CacheConfig.rerank_factor, which re-scores the top
+    candidates with the full-precision vectors from Redis.
+    """
+    normalized = True
+    # search_knn scores are approximate; EmbeddingCache re-ranks them
+    quantized = True
+    index_type = AnnIndexType.INT8
+
+    # rows converted and scored per matmul; small enough for the float32
+    # scratch block to stay in cache, which matters more than BLAS call count
+    SCAN_CHUNK = 1024
+
+    def __init__(self, max_elements: int, dimension: int, params: Optional[HnswParams] = None):
+        self.lock = RWLock()
+        # ef has no effect on a flat scan, it's kept so tuning code can run
+        self.params = replace(params) if params else HnswParams()
+        self._allocate(max_elements, dimension)
+
+    def _allocate(self, max_elements: int, dimension: int) -> None:
+        self.dimension = dimension
+        self.max_elements = max_elements
+        self.codes = np.zeros((max_elements, dimension), dtype=np.int8)
+        self.scales = np.zeros(max_elements, dtype=np.float32)
+        self.labels = np.full(max_elements, -1, dtype=np.int64)
+        self.live = np.zeros(max_elements, dtype=bool)
+        # id -> row; rows of deleted points are reused by later inserts
+        self.rows: dict = {}
+        self.free: List[int] = []
+        self.used = 0
+
+    def init_index(self, max_elements: int, dimension: int) -> None:
+        with self.lock.write():
+            self._allocate(max_elements, dimension)
+
+    def add_pt(self, point: List[float], id: int) -> None:
+        if len(point) != self.dimension:
+            raise ValueError("Point dimensions don't match!")
+        self.add_pts(np.asarray([point]), [id])
+
+    def add_pts(self, points: np.ndarray, ids: List[int]) -> None:
+        points = np.asarray(points, dtype=np.float32).reshape(-1, self.dimension)
+        if len(points) != len(ids):
+            raise ValueError("Number of points and ids don't match!")
+        norms = np.linalg.norm(points, axis=1, keepdims=True)
+        codes, scales = quantize_int8(points / np.where(norms == 0, 1, norms))
+
+        with self.lock.write():
+            for id, code, scale in zip(ids, codes, scales):
+                row = self.rows.get(id)
+                if row is None:
+                    row = self.free.pop() if self.free else self.used
+                    if row == self.used:
+                        if row >= self.max_elements:
+                            raise RuntimeError("The number of elements exceeds the specified limit")
+                        self.used += 1
+                    self.rows[id] = row
+                self.codes[row] = code
+                self.scales[row] = scale
+                self.labels[row] = id
+                self.live[row] = True
+
+    def mark_deleted(self, id: int) -> None:
+        with self.lock.write():
+            row = self.rows.pop(id, None)
+            if row is None:
+                return
+            self.live[row] = False
+            self.free.append(row)
+
+    def get_curr_ct(self) -> int:
+        with self.lock.read():
+            return self._curr_ct()
+
+    def _curr_ct(self) -> int:
+        return len(self.rows)
+
+    def get_max_elements(self) -> int:
+        return self.max_elements
+
+    def resize(self, new_size: int) -> None:
+        with self.lock.write():
+            grow = new_size - self.max_elements
+            if grow <= 0:
+                return
+            self.codes = np.concatenate([self.codes, np.zeros((grow, self.dimension), dtype=np.int8)])
+            self.scales = np.concatenate([self.scales, np.zeros(grow, dtype=np.float32)])
+            self.labels = np.concatenate([self.labels, np.full(grow, -1, dtype=np.int64)])
+            self.live = np.concatenate([self.live, np.zeros(grow, dtype=bool)])
+            self.max_elements = new_size
+
+    def search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
+        with self.lock.read():
+            return self._search_knn(query, k)
+
+    def _search_knn(self, query: List[float], k: int) -> List[Tuple[int, float]]:
+        query = np.asarray(query, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1)
+
+        sims = np.empty(self.used, dtype=np.float32)
+        block = np.empty((min(self.SCAN_CHUNK, self.used), self.dimension), dtype=np.float32)
+        for start in range(0, self.used, self.SCAN_CHUNK):
+            end = min(start + self.SCAN_CHUNK, self.used)
+            scratch = block[:end - start]
+            np.copyto(scratch, self.codes[start:end], casting="unsafe")
+            sims[start:end] = (scratch @ query) * self.scales[start:end]
+        sims[~self.live[:self.used]] = -np.inf
+        k = min(k, len(self.rows))
+        if k == 0:
+            return []
+        top = np.argpartition(-sims, k - 1)[:k]
+        top = top[np.argsort(-sims[top])]
+        # same convention as hnswlib's cosine space: distance = 1 - similarity
+        return list(zip(self.labels[top].tolist(), (1.0 - sims[top]).tolist()))
+
+    def get_pts(self, ids: List[int]) -> np.ndarray:
+        with self.lock.read():
+            return self._get_pts(ids)
+
+    def _get_pts(self, ids: List[int]) -> np.ndarray:
+        try:
+            rows = [self.rows[id] for id in ids]
+        except KeyError:
+            raise RuntimeError("Label not found")
+        # unit length before quantization; renormalize away the rounding
+        return normalize_rows(dequantize_int8(self.codes[rows], self.scales[rows]))
+
+    def contains(self, id: int) -> bool:
+        with self.lock.read():
+            return id in self.rows
+
+    def get_ids(self) -> List[int]:
+        with self.lock.read():
+            return list(self.rows)
+
+    def set_ef(self, ef: int) -> None:
+        self.params.ef = ef
+
+    def get_ef(self) -> int:
+        return self.params.ef
+
+    def save(self, path: str, log_cursor: str) -> None:
+        with self.lock.read():
+            used = self.used
+            meta = {
+                "index_type": self.index_type.value,
+                "dimension": self.dimension,
+                "max_elements": self.max_elements,
+                "log_cursor": log_cursor,
+            }
+            # np.savez would append .npz to a bare path, a file object avoids that
+            with open(path + ".tmp", "wb") as f:
+                np.savez(
+                    f,
+                    codes=self.codes[:used],
+                    scales=self.scales[:used],
+                    labels=self.labels[:used],
+                    live=self.live[:used],
+                )
+        with open(path + ".json.tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(path + ".tmp", path)
+        os.replace(path + ".json.tmp", path + ".json")
+
+    def load(self, path: str) -> Optional[str]:
+        if not (os.path.exists(path) and os.path.exists(path + ".json")):
+            return None
+
+        with open(path + ".json") as f:
+            meta = json.load(f)
+        if meta.get("index_type") != self.index_type.value:
+            logger.warning(f"Ignoring snapshot {path}: index type {meta.get('index_type')} != {self.index_type.value}")
+            return None
+        if meta["dimension"] != self.dimension:
+            logger.warning(f"Ignoring snapshot {path}: dimension {meta['dimension']} != {self.dimension}")
+            return None
+        if "log_cursor" not in meta:
+            # older snapshots carry an id watermark, which can't be replayed from
+            logger.warning(f"Ignoring snapshot {path}: no log cursor")
+            return None
+
+        with np.load(path) as data:
+            codes, scales, labels, live = data["codes"], data["scales"], data["labels"], data["live"]
+        with self.lock.write():
+            self._allocate(max(meta["max_elements"], self.max_elements, len(codes)), self.dimension)
+            used = len(codes)
+            self.codes[:used] = codes
+            self.scales[:used] = scales
+            self.labels[:used] = labels
+            self.live[:used] = live
+            self.used = used
+            self.rows = {int(label): row for row, label in enumerate(labels.tolist()) if live[row]}
+            self.free = [row for row in range(used) if not live[row]]
+        return meta["log_cursor"]
+
+
+def new_ann_index(kind: AnnIndexType, max_elements: int, dimension: int, params: Optional[HnswParams] = None) -> ANNIndex:
+    if kind == AnnIndexType.INT8:
+        return QuantizedAnnIndex(max_elements, dimension, params=params)
+    return HnswAnnIndex(max_elements, dimension, params=params)
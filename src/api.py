@@ -1,26 +1,105 @@
-from openai import OpenAI
-import requests
+import asyncio
+import contextvars
 from PIL import Image
-from transformers import AutoTokenizer, CLIPProcessor, CLIPModel
 from src.config import *
-from src.utils import logger
+from src.utils import logger, hash_file
+from src.caption_cache import CaptionCache
+from src.http_clients import get_async_openai_client, get_openai_client, get_session
+from src.metrics import metrics
 from src.custom_types import EmbeddingData
-from typing import Optional
+from typing import Any, Callable, Dict, Iterable, Optional
 import base64
-from dataclasses import dataclass
+import threading
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
 
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from sentence_transformers import SentenceTransformer
 
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-tokenizer = AutoTokenizer.from_pretrained("openai/clip-vit-base-patch32")
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+CAPTION_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+# SENTENCE_MODEL_NAME = "all-MiniLM-L6-v2"
+SENTENCE_MODEL_NAME = "All-MPNet-Base-V2"
 
-caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
 
-# embed_model = SentenceTransformer("all-MiniLM-L6-v2")
-embed_model = SentenceTransformer("All-MPNet-Base-V2")
+def _load_clip_model():
+    from transformers import CLIPModel
+    return CLIPModel.from_pretrained(CLIP_MODEL_NAME)
+
+def _load_clip_processor():
+    from transformers import CLIPProcessor
+    return CLIPProcessor.from_pretrained(CLIP_MODEL_NAME)
+
+def _load_clip_tokenizer():
+    from transformers import AutoTokenizer
+    return AutoTokenizer.from_pretrained(CLIP_MODEL_NAME)
+
+def _load_caption_model():
+    from transformers import BlipForConditionalGeneration
+    return BlipForConditionalGeneration.from_pretrained(CAPTION_MODEL_NAME)
+
+def _load_caption_processor():
+    from transformers import BlipProcessor
+    return BlipProcessor.from_pretrained(CAPTION_MODEL_NAME)
+
+def _load_embed_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(SENTENCE_MODEL_NAME)
+
+
+class ModelRegistry:
+    """
+    Loads each model the first time it is requested and keeps it for the
+    lifetime of the process. Loading is guarded per model, so concurrent
+    first calls only load once.
+    """
+    def __init__(self, loaders: Dict[str, Callable[[], Any]]):
+        self._loaders = loaders
+        self._models: Dict[str, Any] = {}
+        self._locks = {name: threading.Lock() for name in loaders}
+
+    def get(self, name: str) -> Any:
+        model = self._models.get(name)
+        if model is not None:
+            return model
+
+        with self._locks[name]:
+            if name not in self._models:
+                logger.debug(f"Loading model '{name}'")
+                self._models[name] = self._loaders[name]()
+        return self._models[name]
+
+    def is_loaded(self, name: str) -> bool:
+        return name in self._models
+
+    def load(self, names: Iterable[str]) -> None:
+        for name in names:
+            self.get(name)
+
+
+models = ModelRegistry({
+    "clip_model": _load_clip_model,
+    "clip_processor": _load_clip_processor,
+    "clip_tokenizer": _load_clip_tokenizer,
+    "caption_model": _load_caption_model,
+    "caption_processor": _load_caption_processor,
+    "embed_model": _load_embed_model,
+})
+
+# Models each embedding mode touches on its miss path
+MODE_MODELS = {
+    EmbeddingMode.SINGLESTEP: ["clip_model", "clip_processor", "clip_tokenizer"],
+    EmbeddingMode.TWOSTEP: ["caption_model", "caption_processor", "embed_model"],
+}
+
+
+caption_cache = CaptionCache(max_size=CAPTION_CACHE_SIZE)
+
+
+def warmup(mode: EmbeddingMode = EMBEDDING_MODE) -> None:
+    """
+    Preload the models used by `mode`, so the first query doesn't pay for it.
+    """
+    logger.info(f"Warming up models for '{mode.value}' embeddings")
+    models.load(MODE_MODELS[mode])
 
 @dataclass
 class LLMInput:
@@ -32,31 +111,38 @@ class LLMOutput:
     text: str = ""
     is_hit: bool = False
     best_candidate: EmbeddingData = None
+    # answered by another caller's in-flight LLM call
+    coalesced: bool = False
+    # stage -> ms for this query, empty when metrics are disabled
+    timings: Dict[str, float] = field(default_factory=dict)
+
+
+def _image_messages(llm_input: LLMInput, options: GPTOptions) -> list[dict]:
+    base64_image = encode_image(llm_input.image)
+    return [
+        {
+            "role": "user",
+            "content": [
+                { "type": "text", "text": options.prefix + llm_input.text },
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:image/jpeg;base64,{base64_image}",
+                    },
+                },
+            ],
+        }
+    ]
 
 
 def get_gpt_response(llm_input: LLMInput, options: GPTOptions) -> str:
     logger.debug("IN GPT RESPONSE")
-    client = OpenAI(api_key=options.api_key)
+    client = get_openai_client(options.api_key)
 
     if llm_input.image != "":
-        base64_image = encode_image(llm_input.image)
-
         completion = client.chat.completions.create(
-        model="gpt-4.1",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    { "type": "text", "text": options.prefix + llm_input.text },
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{base64_image}",
-                        },
-                    },
-                ],
-            }
-        ],
+            model="gpt-4.1",
+            messages=_image_messages(llm_input, options),
         )
         return completion.choices[0].message.content
     else:
@@ -67,56 +153,162 @@ def get_gpt_response(llm_input: LLMInput, options: GPTOptions) -> str:
     return response.output_text
 
 
+async def aget_gpt_response(llm_input: LLMInput, options: GPTOptions) -> str:
+    logger.debug("IN ASYNC GPT RESPONSE")
+    client = get_async_openai_client(options.api_key)
+
+    if llm_input.image != "":
+        completion = await client.chat.completions.create(
+            model="gpt-4.1",
+            messages=_image_messages(llm_input, options),
+        )
+        return completion.choices[0].message.content
+    else:
+        response = await client.responses.create(
+            model="gpt-4.1",
+            input=options.prefix + llm_input.text
+        )
+    return response.output_text
+
+
 def get_embedding(llm_input: LLMInput, options: EmbeddingOptions) -> list[float]:
+    if EMBEDDING_MODE == EmbeddingMode.SINGLESTEP:
+        return singlestep_get_embedding(llm_input, options)
     return twostep_get_embedding(llm_input, options)
 
+async def aget_embedding(
+    llm_input: LLMInput,
+    options: EmbeddingOptions,
+    executor: Optional[Executor] = None,
+) -> list[float]:
+    """
+    `get_embedding` run on `executor` (the loop's default if None), so model
+    inference doesn't block the event loop.
+    """
+    loop = asyncio.get_running_loop()
+    # carry the caller's context over, so stage timings land on its query
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(executor, ctx.run, get_embedding, llm_input, options)
+
+def get_embeddings(llm_inputs: list[LLMInput], options: EmbeddingOptions) -> list[list[float]]:
+    """
+    Batched `get_embedding`: returns one [text_emb, img_emb] pair per input, in input order.
+    """
+    if EMBEDDING_MODE == EmbeddingMode.SINGLESTEP:
+        return singlestep_get_embeddings(llm_inputs, options)
+    return twostep_get_embeddings(llm_inputs, options)
+
+
+def _batches(items: list, batch_size: int = EMBEDDING_BATCH_SIZE):
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
 def singlestep_get_embedding(llm_input: LLMInput, options: EmbeddingOptions) -> list[float]:
-    if len(llm_input.image) == 0: 
-        url = "https://api.openai.com/v1/embeddings"
+    return singlestep_get_embeddings([llm_input], options)[0]
 
-        prompt = llm_input.text
+@metrics.timed("embed")
+def singlestep_get_embeddings(llm_inputs: list[LLMInput], options: EmbeddingOptions) -> list[list[float]]:
+    return embed_inputs(llm_inputs, options)
 
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {options.api_key}",
-        }
-        payload = {"model": options.model, "input": prompt}
-        
-        resp = requests.post(url, json=payload, headers=headers)
+def embed_inputs(llm_inputs: list[LLMInput], options: EmbeddingOptions) -> list[list[float]]:
+    """
+    singlestep_get_embeddings without the "embed" stage timing, for callers
+    that time their embeddings under a stage of their own.
+    """
+    results: list = [None] * len(llm_inputs)
+    text_only = [i for i, x in enumerate(llm_inputs) if len(x.image) == 0]
+    with_image = [i for i, x in enumerate(llm_inputs) if len(x.image) != 0]
+
+    url = f"{OPENAI_BASE_URL}/embeddings"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {options.api_key}",
+    }
+    for batch in _batches(text_only):
+        payload = {"model": options.model, "input": [llm_inputs[i].text for i in batch]}
+
+        resp = get_session().post(url, json=payload, headers=headers, timeout=HTTP_TIMEOUT)
         resp.raise_for_status()
-        data = resp.json()
-        return [data["data"][0]["embedding"], []]
-    else: 
+        data = sorted(resp.json()["data"], key=lambda d: d["index"])
+        for i, d in zip(batch, data):
+            results[i] = [d["embedding"], []]
+
+    if with_image:
+        model = models.get("clip_model")
+        processor = models.get("clip_processor")
+        tokenizer = models.get("clip_tokenizer")
+
+    for batch in _batches(with_image):
         #image
-        image_path = llm_input.image
-        img = Image.open(image_path)
-        inputs = processor(images=img, return_tensors="pt")
-        img_emb = model.get_image_features(**inputs)
-        img_emb = img_emb.detach().numpy().flatten()
+        imgs = [Image.open(llm_inputs[i].image) for i in batch]
+        inputs = processor(images=imgs, return_tensors="pt")
+        img_embs = model.get_image_features(**inputs).detach().numpy()
 
         #text
-        inputs = tokenizer([llm_input.text], padding=True, return_tensors="pt")
-        text_emb = model.get_text_features(**inputs)
-        text_emb = text_emb.detach().numpy().flatten()
-        
-        return [text_emb, img_emb]
+        inputs = tokenizer([llm_inputs[i].text for i in batch], padding=True, return_tensors="pt")
+        text_embs = model.get_text_features(**inputs).detach().numpy()
+
+        for i, text_emb, img_emb in zip(batch, text_embs, img_embs):
+            results[i] = [text_emb.flatten(), img_emb.flatten()]
+
+    return results
+
 
 def twostep_get_embedding(llm_input: LLMInput, options: EmbeddingOptions) -> list[float]:
-    # convert image to text using local captioning model
-    assert(llm_input.image != "")
+    return twostep_get_embeddings([llm_input], options)[0]
+
+def twostep_get_embeddings(llm_inputs: list[LLMInput], options: EmbeddingOptions) -> list[list[float]]:
+    # convert images to text using local captioning model
+    for llm_input in llm_inputs:
+        assert(llm_input.image != "")
+
+    captions = caption_images([x.image for x in llm_inputs])
+    texts_to_embed = [
+        f"{llm_input.text}.{caption}".strip()
+        for llm_input, caption in zip(llm_inputs, captions)
+    ]
+
+    with metrics.stage("embed"):
+        embeddings = models.get("embed_model").encode(
+            texts_to_embed,
+            batch_size=EMBEDDING_BATCH_SIZE,
+            show_progress_bar=False,
+        )
+
+    return [[embedding, []] for embedding in embeddings]
+
+
+@metrics.timed("caption")
+def caption_images(image_paths: list[str]) -> list[str]:
+    """
+    Caption each image with BLIP, running `generate` once per padded batch.
+    Captions are memoized in `caption_cache` by a hash of the image bytes, so
+    only images not seen before are captioned.
+    """
+    digests = [hash_file(path) for path in image_paths]
+    captions = dict(zip(digests, caption_cache.get_many(digests)))
+
+    # one representative path per uncaptioned image
+    pending = {}
+    for path, digest in zip(image_paths, digests):
+        if captions[digest] is None:
+            pending.setdefault(digest, path)
 
-    img = Image.open(llm_input.image)
-    cap_inputs = caption_processor(images=img, return_tensors="pt")
-    cap_ids = caption_model.generate(**cap_inputs, max_length=500)
-    caption = caption_processor.decode(cap_ids[0], skip_special_tokens=True)
-    text_to_embed = f"{llm_input.text}.{caption}".strip()
+    if pending:
+        caption_model = models.get("caption_model")
+        caption_processor = models.get("caption_processor")
 
-    embedding = embed_model.encode(
-        text_to_embed,
-        show_progress_bar=True,
-    )
+    for batch in _batches(list(pending.items())):
+        imgs = [Image.open(path) for _, path in batch]
+        cap_inputs = caption_processor(images=imgs, return_tensors="pt")
+        cap_ids = caption_model.generate(**cap_inputs, max_length=500)
+        decoded = caption_processor.batch_decode(cap_ids, skip_special_tokens=True)
+        for (digest, _), caption in zip(batch, decoded):
+            caption_cache.put(digest, caption)
+            captions[digest] = caption
 
-    return [embedding, []]
+    return [captions[digest] for digest in digests]
 
 
 # Function to encode the image
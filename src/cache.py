@@ -1,82 +1,430 @@
-from typing import List
-from .cache_client import CacheClient
-from .ann_index import ANNIndex
-from .custom_types import EmbeddingData
-from .utils import get_unix_seconds, logger
-
+import asyncio
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Dict, List
-from .cache_client import CacheClient
+import itertools
+import numpy as np
+import os
+import threading
+import uuid
+from typing import Dict, Iterable, List, Optional, Tuple
+from .cache_client import AsyncCacheClient, AsyncCachePipeline, CacheClient, CachePipeline
 from .ann_index import ANNIndex
-from .custom_types import EmbeddingData
-from .utils import get_unix_seconds, logger
-from .config import Modality
+from .custom_types import EmbeddingData, SearchResult
+from .embedding_codec import decode_embedding, encode_embedding
+from .lru import LRUCache
+from .metrics import metrics
+from .utils import get_unix_seconds, get_unix_time, hash_bytes, hash_file, logger
+from .config import TARGET_RECALL, EvictionPolicy, Modality
+from .similarity import normalize_rows, score_candidates
+from .tuning import EfTuning, tune_ef
+from .singleflight import SingleFlight
 from .api import LLMInput
 
+
+def _log_pos(entry_id: str) -> Tuple[int, int]:
+    # stream ids are "<ms>-<seq>" and only order numerically
+    ms, seq = entry_id.split("-")
+    return int(ms), int(seq)
+
 @dataclass
 class CacheConfig:
     client: CacheClient
     ann_index: ANNIndex
     embedding_size: int
+    # one past the highest id this process knows of; ids themselves are
+    # allocated in Redis so every worker sharing the cache gets unique ones
     current_id: int = 0
     index_initialized: bool = False
     initial_size: int = 1000
+    # capacity multiplier when the ANN index fills up
+    growth_factor: float = 2.0
+    # local file the ANN graph is saved to / restored from; None disables snapshots
+    snapshot_path: Optional[str] = None
+    # cap on live entries, enforced on write; None means unbounded
+    max_entries: Optional[int] = None
+    eviction_policy: EvictionPolicy = EvictionPolicy.LRU
+    # used by the a* methods (asemantic_search, astore_embedding, ...)
+    async_client: Optional[AsyncCacheClient] = None
+    # HSCAN batch size when loading the index from Redis
+    load_chunk_size: int = 1000
+    # how often searches pull other workers' inserts/removals from the log
+    sync_interval: float = 0.5
+    # L0 hits' usage updates wait for the next write's round trip, or at
+    # most this many seconds
+    hit_flush_interval: float = 1.0
+    # approximate cap on the insert log stream
+    log_max_len: int = 100000
+    # last insert log entry applied to this process's index
+    log_cursor: str = "0-0"
+    last_sync: float = 0.0
+    # store vectors in Redis as int8 codes (4x smaller, slightly lossy)
+    quantize_vectors: bool = False
+    # with a quantized ANN index, fetch k * rerank_factor candidates and keep
+    # the k closest by the vectors stored in Redis
+    rerank_factor: int = 1
+    # ids reserved from Redis per INCRBY, so most stores skip that round trip;
+    # ids left unused when the process exits are skipped, never reused
+    id_block_size: int = 64
 
 class EmbeddingCache:
+    """
+    Safe to share between threads. Searches run concurrently under the ANN
+    index's read lock. Index writers (inserts, log replay, loading,
+    clearing) are serialized per modality, so a capacity check and the
+    insert it guards can't interleave with another writer; resizes and
+    rebuilds happen under the index's write lock, so a search sees either
+    the old graph or the new one. Only one thread replays the insert log
+    at a time; searches skip the replay while another is running.
+    """
     def __init__(
         self,
         configs: Dict[Modality, CacheConfig],
         redis_key_prefix: str,
         cache_ttl: int,
+        exact_cache_size: int = 10000,
     ):
         """
         configs: map from modality name (e.g. "text", "image") to its CacheConfig
         redis_key_prefix: base key (we’ll append the modality)
-        cache_ttl: seconds until each hash key expires
+        cache_ttl: seconds until each entry expires
+        exact_cache_size: max entries in the in-memory exact-match (L0) layer
         """
         self.configs = configs
         self.redis_key_prefix = redis_key_prefix
         self.cache_ttl = cache_ttl
+        # metadata only (no embedding): an exact hit needs just the response
+        self.exact: LRUCache[EmbeddingData] = LRUCache(exact_cache_size)
+        # id -> exact_key of the L0 entries this process stored, so removing
+        # an id drops its L0 entry too
+        self._exact_keys: Dict[Modality, Dict[int, str]] = {m: {} for m in configs}
+        self._exact_lock = threading.Lock()
+        # misses whose LLM call is still running, keyed by exact_key
+        self.inflight = SingleFlight()
+        # tags this process's insert log entries so it can skip its own
+        self.worker_id = uuid.uuid4().hex
+        # serializes index writers; reentrant since loading inserts too
+        self._write_locks = {m: threading.RLock() for m in configs}
+        # held while replaying the insert log
+        self._sync_locks = {m: threading.Lock() for m in configs}
+        # usage updates of L0 hits not sent yet: id -> last hit time (LRU)
+        # or hit count (LFU), and when each modality's were last sent
+        self._pending_hits: Dict[Modality, Dict[int, float]] = {m: {} for m in configs}
+        self._hits_sent = {m: get_unix_time() for m in configs}
+        self._hits_lock = threading.Lock()
+        # guards current_id and the id blocks, which async writers use from
+        # the event loop
+        self._id_lock = threading.Lock()
+        # [next, end) of the ids this process has reserved but not used yet
+        self._id_blocks: Dict[Modality, Tuple[int, int]] = {m: (0, 0) for m in configs}
+        # log cursor each local write started at, for writes whose log entry
+        # may be in Redis before they reach the index (see `_local_write`)
+        self._pending_writes: Dict[Modality, Dict[int, str]] = {m: {} for m in configs}
+        self._pending_lock = threading.Lock()
+        self._write_seq = itertools.count()
+        for modality, cfg in configs.items():
+            metrics.register_gauge(
+                "index_size", cfg.ann_index.get_curr_ct,
+                labels={"cache": redis_key_prefix, "modality": modality.value},
+            )
 
 
     def _redis_key(self, modality: Modality) -> str:
-        key = f"{self.redis_key_prefix}:{modality.value}"
-        print("KEY", key)
-        return key
+        return f"{self.redis_key_prefix}:{modality.value}"
+
+
+    def _vector_key(self, modality: Modality) -> str:
+        # packed embeddings live next to the metadata hash, under the same ids
+        return f"{self._redis_key(modality)}:vec"
+
+
+    def _expiry_key(self, modality: Modality) -> str:
+        # sorted set of id -> unix time the entry expires at
+        return f"{self._redis_key(modality)}:expiry"
+
+
+    def _usage_key(self, modality: Modality) -> str:
+        # sorted set of id -> last hit time (LRU) or hit count (LFU)
+        return f"{self._redis_key(modality)}:usage"
+
+
+    def _id_key(self, modality: Modality) -> str:
+        # INCR counter holding the number of ids handed out (or reserved) so far
+        return f"{self._redis_key(modality)}:next_id"
+
+
+    def _log_key(self, modality: Modality) -> str:
+        # stream of {op: add|del, ids, origin} that workers tail to stay in sync
+        return f"{self._redis_key(modality)}:log"
+
+
+    def _is_expired(self, entry: EmbeddingData) -> bool:
+        return bool(self.cache_ttl) and get_unix_seconds() - entry.timestamp >= self.cache_ttl
+
+
+    @staticmethod
+    def _parse_entry(meta_raw, vec_raw) -> EmbeddingData:
+        entry = EmbeddingData.model_validate_json(meta_raw)
+        # entries written before the binary format still carry the
+        # embedding inline in their JSON
+        if vec_raw is not None:
+            entry.embedding = decode_embedding(vec_raw).tolist()
+        return entry
+
+
+    def exact_key(self, modality: Modality, llm_input: LLMInput) -> str:
+        # normalized prompt text + image content, so whitespace/case changes
+        # and renamed copies of the same image still match
+        text = " ".join(llm_input.text.split()).casefold()
+        image = hash_file(llm_input.image) if llm_input.image else ""
+        return hash_bytes(f"{modality.value}\0{text}\0{image}".encode("utf-8"))
+
+
+    @metrics.timed("exact_lookup")
+    def lookup_exact(
+        self,
+        modality: Modality,
+        llm_input: LLMInput,
+        key: Optional[str] = None,
+    ) -> Optional[EmbeddingData]:
+        """
+        The L0 entry for `llm_input`, without its embedding. `key` is its
+        `exact_key`, if the caller already has it (hashing an image reads
+        the whole file).
+        """
+        key = key or self.exact_key(modality, llm_input)
+        entry = self.exact.get(key)
+        if entry is None:
+            return None
+
+        if self._is_expired(entry):
+            self.exact.pop(key)
+            return None
+        return entry
+
+
+    def _remember_exact(self, modality: Modality, key: str, payload: EmbeddingData) -> None:
+        with self._exact_lock:
+            self._exact_keys[modality][payload.id] = key
+        self.exact.put(key, payload.model_copy(update={"embedding": []}))
+
+
+    def _forget_exact(self, modality: Modality, ids: Iterable[int]) -> None:
+        with self._exact_lock:
+            keys = [(int(eid), self._exact_keys[modality].pop(int(eid), None)) for eid in ids]
+        for eid, key in keys:
+            entry = self.exact.get(key) if key is not None else None
+            # the same prompt may have been stored again under a newer id
+            if entry is not None and entry.id == eid:
+                self.exact.pop(key)
 
 
     def _load_index(self, modality: Modality) -> None:
+        """
+        Build the ANN index from the packed vectors in Redis (or from the
+        snapshot plus whatever was written after it). Entries still in the
+        pre-binary JSON format are not loaded until `migrate_embeddings` runs.
+        Callers hold the modality's write lock (see `_ensure_loaded`).
+        """
         cfg = self.configs[modality]
-        logger.debug(f"Loading '{modality}' index")
-        data = self.get_all_embeddings(modality)
-        if not data and not cfg.index_initialized:
+        # anything logged after this point is replayed by catch_up, so
+        # nothing written while we scan is missed
+        cursor = cfg.client.x_last_id(self._log_key(modality))
+        cfg.log_cursor = cursor.decode() if cursor else "0-0"
+        cfg.last_sync = get_unix_time()
+
+        if not (cfg.snapshot_path and self._load_snapshot(modality)):
+            logger.debug(f"Loading '{modality}' index")
             cfg.ann_index.init_index(cfg.initial_size, cfg.embedding_size)
-        else:
-            cfg.ann_index.init_index(len(data), cfg.embedding_size)
-            max_id = 0
-            for d in data:
-                cfg.ann_index.add_pt(d.embedding, d.id)
-                max_id = max(max_id, d.id)
-            cfg.current_id = max_id + 1
+            max_id = self._stream_vectors(modality)
+            self._bump_current_id(cfg, max_id + 1)
+
+        # data written before ids came from Redis may be ahead of the counter
+        allocated = cfg.client.incr_by(self._id_key(modality), 0)
+        if allocated < cfg.current_id:
+            cfg.client.incr_by(self._id_key(modality), cfg.current_id - allocated)
         cfg.index_initialized = True
 
 
-    def store_embedding(
+    def _ensure_loaded(self, modality: Modality) -> None:
+        cfg = self.configs[modality]
+        if cfg.index_initialized:
+            return
+        with self._write_locks[modality]:
+            # another thread may have loaded it while we waited
+            if not cfg.index_initialized:
+                self._load_index(modality)
+
+
+    def _load_snapshot(self, modality: Modality) -> bool:
+        cfg = self.configs[modality]
+        cursor = cfg.ann_index.load(cfg.snapshot_path)
+        if cursor is None:
+            return False
+
+        # the log is capped, so entries written since the snapshot may be gone
+        first = cfg.client.x_read(self._log_key(modality), "0-0", 1)
+        oldest = first[0][0].decode() if first else None
+        if (oldest is None and cursor != "0-0") or (oldest is not None and _log_pos(oldest) > _log_pos(cursor)):
+            logger.warning(f"Insert log no longer reaches back to snapshot {cfg.snapshot_path}, reloading from Redis")
+            return False
+
+        # replay only what was logged after the snapshot
+        cfg.log_cursor = cursor
+        read = self._replay_log(modality)
+        ids = cfg.ann_index.get_ids()
+        if ids:
+            self._bump_current_id(cfg, max(ids) + 1)
+        logger.debug(f"Restored '{modality}' index from {cfg.snapshot_path} (log {cursor}, replayed {read} entries)")
+        return True
+
+
+    def _stream_vectors(self, modality: Modality) -> int:
+        """
+        HSCAN the vector hash in chunks, inserting each vector into the index
+        as its chunk arrives. Returns the highest id seen (or -1 if none).
+        """
+        cfg = self.configs[modality]
+        vec_key = self._vector_key(modality)
+        max_id = -1
+        loaded = 0
+
+        cursor = 0
+        while True:
+            cursor, chunk = cfg.client.h_scan(vec_key, cursor, cfg.load_chunk_size)
+            ids = []
+            vecs = []
+            for field, raw in chunk.items():
+                eid = int(field)
+                # HSCAN can return a field again in a later chunk; adding an
+                # id twice could take a second slot for it
+                if not cfg.ann_index.contains(eid):
+                    ids.append(eid)
+                    vecs.append(decode_embedding(raw))
+
+            if ids:
+                self._grow_index(modality, len(ids))
+                cfg.ann_index.add_pts(np.stack(vecs), ids)
+                max_id = max(max_id, max(ids))
+                loaded += len(ids)
+
+            if cursor == 0:
+                break
+
+        logger.debug(f"Streamed {loaded} '{modality}' vectors into the index")
+        return max_id
+
+
+    def save_snapshot(self, modality: Modality) -> None:
+        """
+        Save the index along with the log cursor it is current up to. That is
+        the replay cursor, held back to where any local write still on its
+        way to the index started, so loading the snapshot replays it.
+        """
+        cfg = self.configs[modality]
+        if not cfg.snapshot_path or not cfg.index_initialized:
+            return
+        with self._sync_locks[modality]:
+            self._replay_log(modality)
+            with self._pending_lock:
+                cursor = min([cfg.log_cursor, *self._pending_writes[modality].values()], key=_log_pos)
+            cfg.ann_index.save(cfg.snapshot_path, cursor)
+        logger.debug(f"Saved '{modality}' index snapshot to {cfg.snapshot_path} (log {cursor})")
+
+
+    @contextmanager
+    def _local_write(self, modality: Modality):
+        """
+        Wraps a local write from before its log entry is queued until the
+        index has it, so `save_snapshot` doesn't place its cursor past an
+        entry the saved index may be missing.
+        """
+        token = next(self._write_seq)
+        with self._pending_lock:
+            self._pending_writes[modality][token] = self.configs[modality].log_cursor
+        try:
+            yield
+        finally:
+            with self._pending_lock:
+                del self._pending_writes[modality][token]
+
+
+    def _bump_current_id(self, cfg: CacheConfig, end: int) -> None:
+        with self._id_lock:
+            cfg.current_id = max(cfg.current_id, end)
+
+
+    def tune_ef(
         self,
         modality: Modality,
-        llm_input: LLMInput,
-        embedding: List[float],
-        response: str,
-    ) -> None:
+        k: int,
+        target_recall: float = TARGET_RECALL,
+        sample_size: int = 200,
+    ) -> EfTuning:
+        """
+        Set the modality's query-time ef to the smallest value that reaches
+        `target_recall` at `k` on the current index (see `tuning.tune_ef`).
+        """
+        self._ensure_loaded(modality)
+        result = tune_ef(self.configs[modality].ann_index, k, target_recall, sample_size)
+        logger.info(f"Tuned '{modality}' ef={result.ef} for recall@{k} >= {target_recall} (met: {result.met_target})")
+        return result
+
+
+    def _take_ids(self, modality: Modality, n: int) -> Optional[List[int]]:
+        # n ids from this process's reserved block, or None if it runs short
+        with self._id_lock:
+            start, end = self._id_blocks[modality]
+            if end - start < n:
+                return None
+            self._id_blocks[modality] = (start + n, end)
+        return list(range(start, start + n))
+
+
+    def _reserve_ids(self, modality: Modality, n: int, end: int, reserved: int) -> List[int]:
+        # the first n of the `reserved` ids ending at `end` are used now, the
+        # rest become the new block
+        start = end - reserved
+        with self._id_lock:
+            self._id_blocks[modality] = (start + n, end)
+        self._bump_current_id(self.configs[modality], end)
+        return list(range(start, start + n))
+
+
+    def _allocate_ids(self, modality: Modality, n: int) -> List[int]:
+        ids = self._take_ids(modality, n)
+        if ids is not None:
+            return ids
+        cfg = self.configs[modality]
+        reserved = max(n, cfg.id_block_size)
+        end = cfg.client.incr_by(self._id_key(modality), reserved)
+        return self._reserve_ids(modality, n, end, reserved)
+
+
+    async def _aallocate_ids(self, modality: Modality, n: int) -> List[int]:
+        ids = self._take_ids(modality, n)
+        if ids is not None:
+            return ids
+        cfg = self.configs[modality]
+        reserved = max(n, cfg.id_block_size)
+        end = await self._async_client(modality).incr_by(self._id_key(modality), reserved)
+        return self._reserve_ids(modality, n, end, reserved)
+
+
+    def _check_size(self, modality: Modality, embedding: List[float]) -> None:
         cfg = self.configs[modality]
         if len(embedding) != cfg.embedding_size:
             logger.error(f"Size mismatch for {modality}: {len(embedding)} vs {cfg.embedding_size}")
             raise ValueError("Embedding size mismatch")
 
-        eid = cfg.current_id
-        cfg.current_id += 1
 
-        payload = EmbeddingData(
+    def _new_entry(
+        self,
+        eid: int,
+        llm_input: LLMInput,
+        embedding: List[float],
+        response: str,
+    ) -> EmbeddingData:
+        return EmbeddingData(
             id=eid,
             query=llm_input.text,
             image=llm_input.image,
@@ -85,55 +433,733 @@ class EmbeddingCache:
             timestamp=get_unix_seconds()
         )
 
-        payload_json = payload.model_dump_json()
 
-        key = self._redis_key(modality)
-        cfg.client.h_set(key, str(eid), payload_json)
-        if self.cache_ttl:
-            cfg.client.expire(key, self.cache_ttl)
+    def _ensure_capacity(self, modality: Modality, n: int) -> None:
+        # callers hold the write lock, so the room made here is still free
+        # when they insert
+        self._ensure_loaded(modality)
+        self._grow_index(modality, n)
 
-        if not cfg.index_initialized:
-            cfg.ann_index.init_index(cfg.initial_size, cfg.embedding_size)
-            cfg.index_initialized = True
 
-        if cfg.ann_index.get_curr_ct() >= cfg.ann_index.get_max_elements():
-            new_size = cfg.ann_index.get_curr_ct() + 1000
+    def _grow_index(self, modality: Modality, n: int) -> None:
+        cfg = self.configs[modality]
+        needed = cfg.ann_index.get_curr_ct() + n
+        if needed > cfg.ann_index.get_max_elements():
+            new_size = max(int(cfg.ann_index.get_max_elements() * cfg.growth_factor), needed)
             logger.debug(f"Resizing '{modality}' ANN index → {new_size}")
             cfg.ann_index.resize(new_size)
 
-        cfg.ann_index.add_pt(embedding, eid)
 
-    def semantic_search(
+    def _index_entry(self, modality: Modality, exact_key: str, payload: EmbeddingData) -> None:
+        with self._write_locks[modality]:
+            self._ensure_capacity(modality, 1)
+            self.configs[modality].ann_index.add_pt(payload.embedding, payload.id)
+        self._remember_exact(modality, exact_key, payload)
+
+
+    @staticmethod
+    def _new_usage_score(cfg: CacheConfig) -> float:
+        # LFU counts start at 1 so a fresh entry isn't the first to go
+        return get_unix_time() if cfg.eviction_policy == EvictionPolicy.LRU else 1
+
+
+    def _queue_entry(self, pipe: CachePipeline, modality: Modality, payload: EmbeddingData) -> None:
+        cfg = self.configs[modality]
+        eid = str(payload.id)
+        pipe.h_set(self._redis_key(modality), eid, payload.model_dump_json(exclude={"embedding"}))
+        pipe.h_set(self._vector_key(modality), eid, encode_embedding(payload.embedding, quantize=cfg.quantize_vectors))
+        if self.cache_ttl:
+            pipe.z_add(self._expiry_key(modality), {eid: payload.timestamp + self.cache_ttl})
+        pipe.z_add(self._usage_key(modality), {eid: self._new_usage_score(cfg)})
+
+
+    def _queue_log(self, pipe: CachePipeline, modality: Modality, op: str, ids: List[str]) -> None:
+        fields = {"op": op, "ids": ",".join(ids), "origin": self.worker_id}
+        pipe.x_add(self._log_key(modality), fields, self.configs[modality].log_max_len)
+
+
+    def _queue_maintenance_reads(self, pipe: CachePipeline, modality: Modality) -> None:
+        # ids past their TTL, then the live entry count
+        pipe.z_range_by_score(self._expiry_key(modality), 0, get_unix_seconds())
+        pipe.z_card(self._usage_key(modality))
+
+
+    def _pick_evictions(self, modality: Modality, expired: List[str], count: int) -> Tuple[List[str], int]:
+        """
+        Returns (ids to remove, how many more need evicting beyond those).
+        """
+        cfg = self.configs[modality]
+        if not self.cache_ttl:
+            expired = []
+        excess = count - len(expired) - cfg.max_entries if cfg.max_entries else 0
+        return expired, max(excess, 0)
+
+
+    @metrics.timed("store")
+    def store_embedding(
         self,
         modality: Modality,
+        llm_input: LLMInput,
         embedding: List[float],
-        k: int
-    ) -> List[EmbeddingData]:
+        response: str,
+        exact_key: Optional[str] = None,
+    ) -> None:
+        """
+        `exact_key`: `exact_key(modality, llm_input)`, if the caller already
+        computed it.
+        """
+        cfg = self.configs[modality]
+        self._check_size(modality, embedding)
+        exact_key = exact_key or self.exact_key(modality, llm_input)
+        [eid] = self._allocate_ids(modality, 1)
+        payload = self._new_entry(eid, llm_input, embedding, response)
+
+        # payload, TTL, usage, log entry and the maintenance reads in one round trip
+        with self._local_write(modality):
+            pipe = cfg.client.pipeline()
+            self._queue_entry(pipe, modality, payload)
+            self._queue_log(pipe, modality, "add", [str(eid)])
+            self._queue_hits(pipe, modality, self._take_hits(modality))
+            self._queue_maintenance_reads(pipe, modality)
+            *_, expired, count = pipe.execute()
+
+            self._index_entry(modality, exact_key, payload)
+        self._maintain(modality, [i.decode() for i in expired], count)
+
+
+    def store_embeddings(
+        self,
+        modality: Modality,
+        items: List[Tuple[LLMInput, List[float], str]],
+        chunk_size: int = 500,
+    ) -> None:
+        """
+        Bulk `store_embedding` for (llm_input, embedding, response) items, e.g.
+        when warming the cache. Each chunk is written in one pipelined round
+        trip and inserted into the ANN index in one call.
+        """
+        cfg = self.configs[modality]
+        for start in range(0, len(items), chunk_size):
+            chunk = items[start:start + chunk_size]
+            for _, embedding, _ in chunk:
+                self._check_size(modality, embedding)
+            ids = self._allocate_ids(modality, len(chunk))
+            payloads = [self._new_entry(eid, *item) for eid, item in zip(ids, chunk)]
+
+            with self._local_write(modality):
+                pipe = cfg.client.pipeline(transaction=False)
+                for payload in payloads:
+                    self._queue_entry(pipe, modality, payload)
+                self._queue_log(pipe, modality, "add", [str(eid) for eid in ids])
+                self._queue_hits(pipe, modality, self._take_hits(modality))
+                self._queue_maintenance_reads(pipe, modality)
+                *_, expired, count = pipe.execute()
+
+                with self._write_locks[modality]:
+                    self._ensure_capacity(modality, len(payloads))
+                    cfg.ann_index.add_pts(
+                        np.array([p.embedding for p in payloads], dtype=np.float32),
+                        [p.id for p in payloads],
+                    )
+            for (llm_input, _, _), payload in zip(chunk, payloads):
+                self._remember_exact(modality, self.exact_key(modality, llm_input), payload)
+            self._maintain(modality, [i.decode() for i in expired], count)
+
+
+    def _add_hit(self, modality: Modality, eid: int) -> bool:
+        # returns whether the pending hits are due to be sent
+        cfg = self.configs[modality]
+        now = get_unix_time()
+        with self._hits_lock:
+            hits = self._pending_hits[modality]
+            hits[eid] = now if cfg.eviction_policy == EvictionPolicy.LRU else hits.get(eid, 0) + 1
+            return now - self._hits_sent[modality] >= cfg.hit_flush_interval
+
+
+    def _take_hits(self, modality: Modality) -> Dict[int, float]:
+        with self._hits_lock:
+            hits = self._pending_hits[modality]
+            self._pending_hits[modality] = {}
+            self._hits_sent[modality] = get_unix_time()
+        return hits
+
+
+    def _queue_hits(self, pipe: CachePipeline, modality: Modality, hits: Dict[int, float]) -> None:
+        # xx: an entry removed since it was found must not be re-added to
+        # the usage set, where it would count towards max_entries
+        if not hits:
+            return
+        if self.configs[modality].eviction_policy == EvictionPolicy.LRU:
+            pipe.z_add(self._usage_key(modality), {str(eid): t for eid, t in hits.items()}, xx=True)
+        else:
+            for eid, count in hits.items():
+                pipe.z_incr_by(self._usage_key(modality), str(eid), count, xx=True)
+
+
+    def record_hit(self, modality: Modality, eid: int, defer: bool = False) -> None:
+        """
+        Bump `eid`'s usage score. With `defer` (for L0 hits, which otherwise
+        cost no round trip) the update is held until the next store, or
+        until `hit_flush_interval` has passed.
+        """
+        due = self._add_hit(modality, eid)
+        if defer and not due:
+            return
+        pipe = self.configs[modality].client.pipeline(transaction=False)
+        self._queue_hits(pipe, modality, self._take_hits(modality))
+        pipe.execute()
+
+
+    def _queue_remove(self, pipe: CachePipeline, modality: Modality, ids: List[str]) -> None:
+        pipe.h_del(self._redis_key(modality), ids)
+        pipe.h_del(self._vector_key(modality), ids)
+        pipe.z_rem(self._expiry_key(modality), ids)
+        pipe.z_rem(self._usage_key(modality), ids)
+
+
+    def _remove(self, modality: Modality, ids: List[str]) -> None:
+        if not ids:
+            return
+        cfg = self.configs[modality]
+        with self._local_write(modality):
+            pipe = cfg.client.pipeline()
+            self._queue_remove(pipe, modality, ids)
+            self._queue_log(pipe, modality, "del", ids)
+            pipe.execute()
+            self._unindex(modality, ids)
+
+
+    def _unindex(self, modality: Modality, ids: List[str]) -> None:
+        cfg = self.configs[modality]
+        for eid in ids:
+            cfg.ann_index.mark_deleted(int(eid))
+        self._forget_exact(modality, ids)
+
+
+    def _maintain(self, modality: Modality, expired: List[str], count: int) -> None:
+        """
+        Remove `expired` and evict down to max_entries, given the entry count
+        read alongside them.
+        """
+        cfg = self.configs[modality]
+        remove, excess = self._pick_evictions(modality, expired, count)
+        if excess:
+            # lowest score = least recently / least frequently hit; expired ids
+            # may be among them, so over-fetch by that many
+            lowest = cfg.client.z_range(self._usage_key(modality), 0, excess + len(remove) - 1)
+            skip = set(remove)
+            evicted = [i.decode() for i in lowest if i.decode() not in skip][:excess]
+            logger.debug(f"Evicting {len(evicted)} '{modality}' entries ({cfg.eviction_policy.value})")
+            metrics.inc("evictions", len(evicted))
+            remove = remove + evicted
+
+        if expired:
+            logger.debug(f"Expired {len(expired)} '{modality}' entries")
+            metrics.inc("expirations", len(expired))
+        self._remove(modality, remove)
+
+
+    def remove_entries(self, modality: Modality, ids: List[int]) -> None:
+        """
+        Remove entries by id, from Redis and from every worker's index.
+        """
+        self._ensure_loaded(modality)
+        self._remove(modality, [str(i) for i in ids])
+
+
+    def expire_entries(self, modality: Modality) -> int:
+        """
+        Remove every entry past its TTL; returns how many were removed.
+        """
+        if not self.cache_ttl:
+            return 0
+        cfg = self.configs[modality]
+        ids = [i.decode() for i in cfg.client.z_range_by_score(self._expiry_key(modality), 0, get_unix_seconds())]
+        self._remove(modality, ids)
+        if ids:
+            logger.debug(f"Expired {len(ids)} '{modality}' entries")
+            metrics.inc("expirations", len(ids))
+        return len(ids)
+
+
+    @staticmethod
+    def _parse_log(entries, worker_id: str) -> Tuple[List[int], List[int], bool]:
+        """
+        (adds, dels, cleared) from other workers' log entries; after a
+        clear, only what was logged since it is returned.
+        """
+        adds, dels, cleared = [], [], False
+        for _, fields in entries:
+            if fields[b"origin"].decode() == worker_id:
+                continue
+            if fields[b"op"] == b"clear":
+                adds, dels, cleared = [], [], True
+                continue
+            ids = [int(i) for i in fields[b"ids"].split(b",") if i]
+            (adds if fields[b"op"] == b"add" else dels).extend(ids)
+        return adds, dels, cleared
+
+
+    def _apply_log(self, modality: Modality, adds: List[int], dels: List[int], raw_vecs) -> None:
+        cfg = self.configs[modality]
+        found = [(eid, raw) for eid, raw in zip(adds, raw_vecs) if raw is not None]
+        with self._write_locks[modality]:
+            for eid in dels:
+                cfg.ann_index.mark_deleted(eid)
+            if found:
+                self._grow_index(modality, len(found))
+                cfg.ann_index.add_pts(
+                    np.stack([decode_embedding(raw) for _, raw in found]),
+                    [eid for eid, _ in found],
+                )
+        # another worker may have evicted entries this one stored
+        self._forget_exact(modality, dels)
+        if found:
+            self._bump_current_id(cfg, max(eid for eid, _ in found) + 1)
+
+
+    def _pending_adds(self, modality: Modality, adds: List[int], dels: List[int]) -> List[int]:
+        # skip ids already indexed (e.g. picked up by the initial scan) or
+        # removed again later in the same batch
+        cfg = self.configs[modality]
+        gone = set(dels)
+        return [eid for eid in adds if eid not in gone and not cfg.ann_index.contains(eid)]
+
+
+    def catch_up(self, modality: Modality, batch_size: int = 1000, blocking: bool = True) -> int:
+        """
+        Apply other workers' inserts and removals from the insert log to the
+        local index. Returns the number of log entries read. With
+        blocking=False, returns 0 straight away if another thread is
+        already replaying the log.
+        """
+        cfg = self.configs[modality]
+        if not cfg.index_initialized:
+            return 0
+        sync_lock = self._sync_locks[modality]
+        if not sync_lock.acquire(blocking=blocking):
+            return 0
+
+        try:
+            return self._replay_log(modality, batch_size)
+        finally:
+            sync_lock.release()
+
+
+    def _replay_log(self, modality: Modality, batch_size: int = 1000) -> int:
+        # callers hold the sync lock, or the write lock while loading
+        cfg = self.configs[modality]
+        cfg.last_sync = get_unix_time()
+        read = 0
+        while True:
+            entries = cfg.client.x_read(self._log_key(modality), cfg.log_cursor, batch_size)
+            if not entries:
+                break
+            read += len(entries)
+
+            adds, dels, cleared = self._parse_log(entries, self.worker_id)
+            if cleared:
+                self._reset_index(modality)
+            adds = self._pending_adds(modality, adds, dels)
+            raw_vecs = cfg.client.hm_get(self._vector_key(modality), [str(i) for i in adds]) if adds else []
+            self._apply_log(modality, adds, dels, raw_vecs)
+            cfg.log_cursor = entries[-1][0].decode()
+            if len(entries) < batch_size:
+                break
+        return read
+
+
+    async def acatch_up(self, modality: Modality, batch_size: int = 1000) -> int:
+        """
+        Async `catch_up`. Never waits for the sync lock (that would block the
+        event loop): if a replay is already running it returns 0.
+        """
+        cfg = self.configs[modality]
+        if not cfg.index_initialized:
+            return 0
+        sync_lock = self._sync_locks[modality]
+        if not sync_lock.acquire(blocking=False):
+            return 0
+
+        try:
+            cfg.last_sync = get_unix_time()
+            client = self._async_client(modality)
+            read = 0
+            while True:
+                entries = await client.x_read(self._log_key(modality), cfg.log_cursor, batch_size)
+                if not entries:
+                    break
+                read += len(entries)
+
+                adds, dels, cleared = self._parse_log(entries, self.worker_id)
+                if cleared:
+                    await asyncio.to_thread(self._reset_index, modality)
+                adds = self._pending_adds(modality, adds, dels)
+                raw_vecs = await client.hm_get(self._vector_key(modality), [str(i) for i in adds]) if adds else []
+                await asyncio.to_thread(self._apply_log, modality, adds, dels, raw_vecs)
+                cfg.log_cursor = entries[-1][0].decode()
+                if len(entries) < batch_size:
+                    break
+            return read
+        finally:
+            sync_lock.release()
+
+
+    def _sync_due(self, modality: Modality) -> bool:
+        cfg = self.configs[modality]
+        return get_unix_time() - cfg.last_sync >= cfg.sync_interval
+
+
+    def _search_index(
+        self,
+        modality: Modality,
+        embedding: List[float],
+        k: int,
+    ) -> Tuple[List[Tuple[int, float]], Optional[np.ndarray]]:
+        """
+        kNN search plus the matched vectors (see `ANNIndex.search_with_pts`).
+        """
         cfg = self.configs[modality]
         if len(embedding) != cfg.embedding_size:
             logger.error(f"Size mismatch for {modality}: {len(embedding)} vs {cfg.embedding_size}")
             raise ValueError("Embedding size mismatch")
 
+        with metrics.stage("ann_search"):
+            results, vecs = cfg.ann_index.search_with_pts(embedding, k)
+        logger.debug("ANN results: %s", results)
+        return results, vecs
+
+
+    def _to_results(
+        self,
+        modality: Modality,
+        embedding: List[float],
+        results: List[Tuple[int, float]],
+        vecs: np.ndarray,
+        raw: List[Optional[bytes]],
+    ) -> List[SearchResult]:
+        cfg = self.configs[modality]
+
+        # re-score against the vectors the index already holds, all at once;
+        # when those are unit length only the query needs normalizing
+        normalized = cfg.ann_index.normalized
+        with metrics.stage("score"):
+            if normalized:
+                embedding = normalize_rows(np.asarray(embedding, dtype=np.float32))
+            scores = score_candidates(modality, embedding, vecs, normalized=normalized).tolist()
+
+        # only metadata is fetched; hnswlib's cosine distance is 1 - similarity
+        candidates = []
+        with metrics.stage("deserialize"):
+            for item, (eid, dist), (text_score, image_score) in zip(raw, results, scores):
+                if item is None:
+                    # removed from Redis behind our back (e.g. by another process)
+                    cfg.ann_index.mark_deleted(eid)
+                    self._forget_exact(modality, [eid])
+                    continue
+                entry = self._parse_entry(item, None)
+                if self._is_expired(entry):
+                    continue
+                candidates.append(SearchResult(
+                    entry=entry,
+                    similarity=1.0 - dist,
+                    text_score=text_score,
+                    image_score=image_score,
+                ))
+        return candidates
+
+
+    def _fetch_k(self, modality: Modality, k: int) -> int:
+        cfg = self.configs[modality]
+        return k * cfg.rerank_factor if cfg.ann_index.quantized else k
+
+
+    @staticmethod
+    def _rerank(
+        embedding: List[float],
+        k: int,
+        results: List[Tuple[int, float]],
+        vecs: np.ndarray,
+        raw: List[Optional[bytes]],
+        raw_vecs: List[Optional[bytes]],
+    ):
+        """
+        Re-order candidates from a quantized index by cosine against the
+        vectors stored in Redis (falling back to the index's copy for any
+        that are gone) and keep the best k. The vectors come back unit
+        length, like the index's own.
+        """
+        with metrics.stage("rerank"):
+            full = normalize_rows(np.stack([
+                decode_embedding(rv) if rv is not None else v
+                for v, rv in zip(vecs, raw_vecs)
+            ]))
+            sims = full @ normalize_rows(np.asarray(embedding, dtype=np.float32))
+            order = np.argsort(-sims)[:k]
+        return (
+            [(results[i][0], 1.0 - float(sims[i])) for i in order],
+            full[order],
+            [raw[i] for i in order],
+        )
+
+
+    def semantic_search(
+        self,
+        modality: Modality,
+        embedding: List[float],
+        k: int
+    ) -> List[SearchResult]:
+        cfg = self.configs[modality]
+        if not cfg.index_initialized:
+            self._ensure_loaded(modality)
+        elif self._sync_due(modality):
+            self.catch_up(modality, blocking=False)
+
+        fetch_k = self._fetch_k(modality, k)
+        results, vecs = self._search_index(modality, embedding, fetch_k)
+        if not results:
+            return []
+
+        ids = [str(r[0]) for r in results]
+        if fetch_k == k:
+            with metrics.stage("redis_fetch"):
+                raw = cfg.client.hm_get(self._redis_key(modality), ids)
+            return self._to_results(modality, embedding, results, vecs, raw)
+
+        with metrics.stage("redis_fetch"):
+            pipe = cfg.client.pipeline(transaction=False)
+            pipe.hm_get(self._redis_key(modality), ids)
+            pipe.hm_get(self._vector_key(modality), ids)
+            raw, raw_vecs = pipe.execute()
+        results, vecs, raw = self._rerank(embedding, k, results, vecs, raw, raw_vecs)
+        return self._to_results(modality, embedding, results, vecs, raw)
+
+
+    # asyncio variants of the hot-path operations. They go through
+    # CacheConfig.async_client; the one-off index load still uses the sync
+    # client, on a worker thread.
+
+    def _async_client(self, modality: Modality) -> AsyncCacheClient:
+        client = self.configs[modality].async_client
+        if client is None:
+            raise ValueError(f"No async client configured for '{modality}'")
+        return client
+
+
+    async def asemantic_search(
+        self,
+        modality: Modality,
+        embedding: List[float],
+        k: int
+    ) -> List[SearchResult]:
+        cfg = self.configs[modality]
         if not cfg.index_initialized:
-            self._load_index(modality)
+            await asyncio.to_thread(self._ensure_loaded, modality)
+        elif self._sync_due(modality):
+            await self.acatch_up(modality)
 
-        curr = cfg.ann_index.get_curr_ct()
-        if curr == 0:
+        fetch_k = self._fetch_k(modality, k)
+        # may wait on the index lock behind a writer, and the int8 index
+        # scans every row: keep both off the loop
+        results, vecs = await asyncio.to_thread(self._search_index, modality, embedding, fetch_k)
+        if not results:
             return []
 
-        k = min(k, curr)
-        results = cfg.ann_index.search_knn(embedding, k)
-        print("RESULTS", results)
+        client = self._async_client(modality)
         ids = [str(r[0]) for r in results]
-        raw = cfg.client.hm_get(self._redis_key(modality), ids)
+        if fetch_k == k:
+            with metrics.stage("redis_fetch"):
+                raw = await client.hm_get(self._redis_key(modality), ids)
+            # takes the index write lock for entries removed behind our back
+            return await asyncio.to_thread(self._to_results, modality, embedding, results, vecs, raw)
+
+        with metrics.stage("redis_fetch"):
+            pipe = client.pipeline(transaction=False)
+            await pipe.hm_get(self._redis_key(modality), ids)
+            await pipe.hm_get(self._vector_key(modality), ids)
+            raw, raw_vecs = await pipe.execute()
+        results, vecs, raw = self._rerank(embedding, k, results, vecs, raw, raw_vecs)
+        return await asyncio.to_thread(self._to_results, modality, embedding, results, vecs, raw)
+
+
+    @metrics.timed("store")
+    async def astore_embedding(
+        self,
+        modality: Modality,
+        llm_input: LLMInput,
+        embedding: List[float],
+        response: str,
+        exact_key: Optional[str] = None,
+    ) -> None:
+        client = self._async_client(modality)
+        self._check_size(modality, embedding)
+        exact_key = exact_key or self.exact_key(modality, llm_input)
+        [eid] = await self._aallocate_ids(modality, 1)
+        payload = self._new_entry(eid, llm_input, embedding, response)
+
+        with self._local_write(modality):
+            pipe = client.pipeline()
+            await self._aqueue_entry(pipe, modality, payload)
+            await pipe.x_add(
+                self._log_key(modality),
+                {"op": "add", "ids": str(eid), "origin": self.worker_id},
+                self.configs[modality].log_max_len,
+            )
+            await self._aqueue_hits(pipe, modality, self._take_hits(modality))
+            await pipe.z_range_by_score(self._expiry_key(modality), 0, get_unix_seconds())
+            await pipe.z_card(self._usage_key(modality))
+            *_, expired, count = await pipe.execute()
+
+            # takes the write lock and may load or resize the index, keep it off the loop
+            await asyncio.to_thread(self._index_entry, modality, exact_key, payload)
+        await self._amaintain(modality, [i.decode() for i in expired], count)
+
+
+    async def _aqueue_entry(self, pipe: AsyncCachePipeline, modality: Modality, payload: EmbeddingData) -> None:
+        cfg = self.configs[modality]
+        eid = str(payload.id)
+        await pipe.h_set(self._redis_key(modality), eid, payload.model_dump_json(exclude={"embedding"}))
+        await pipe.h_set(self._vector_key(modality), eid, encode_embedding(payload.embedding, quantize=cfg.quantize_vectors))
+        if self.cache_ttl:
+            await pipe.z_add(self._expiry_key(modality), {eid: payload.timestamp + self.cache_ttl})
+        await pipe.z_add(self._usage_key(modality), {eid: self._new_usage_score(cfg)})
+
+
+    async def _aqueue_hits(self, pipe: AsyncCachePipeline, modality: Modality, hits: Dict[int, float]) -> None:
+        if not hits:
+            return
+        if self.configs[modality].eviction_policy == EvictionPolicy.LRU:
+            await pipe.z_add(self._usage_key(modality), {str(eid): t for eid, t in hits.items()}, xx=True)
+        else:
+            for eid, count in hits.items():
+                await pipe.z_incr_by(self._usage_key(modality), str(eid), count, xx=True)
+
+
+    async def arecord_hit(self, modality: Modality, eid: int, defer: bool = False) -> None:
+        due = self._add_hit(modality, eid)
+        if defer and not due:
+            return
+        pipe = self._async_client(modality).pipeline(transaction=False)
+        await self._aqueue_hits(pipe, modality, self._take_hits(modality))
+        await pipe.execute()
+
+
+    async def _aremove(self, modality: Modality, ids: List[str]) -> None:
+        if not ids:
+            return
+        cfg = self.configs[modality]
+        with self._local_write(modality):
+            pipe = self._async_client(modality).pipeline()
+            await pipe.h_del(self._redis_key(modality), ids)
+            await pipe.h_del(self._vector_key(modality), ids)
+            await pipe.z_rem(self._expiry_key(modality), ids)
+            await pipe.z_rem(self._usage_key(modality), ids)
+            await pipe.x_add(
+                self._log_key(modality),
+                {"op": "del", "ids": ",".join(ids), "origin": self.worker_id},
+                cfg.log_max_len,
+            )
+            await pipe.execute()
+            await asyncio.to_thread(self._unindex, modality, ids)
+
+
+    async def _amaintain(self, modality: Modality, expired: List[str], count: int) -> None:
+        cfg = self.configs[modality]
+        remove, excess = self._pick_evictions(modality, expired, count)
+        if excess:
+            client = self._async_client(modality)
+            lowest = await client.z_range(self._usage_key(modality), 0, excess + len(remove) - 1)
+            skip = set(remove)
+            evicted = [i.decode() for i in lowest if i.decode() not in skip][:excess]
+            logger.debug(f"Evicting {len(evicted)} '{modality}' entries ({cfg.eviction_policy.value})")
+            metrics.inc("evictions", len(evicted))
+            remove = remove + evicted
 
-        return [
-            EmbeddingData.parse_raw(item)
-            for item in raw
-            if item is not None
-        ]
+        if expired:
+            logger.debug(f"Expired {len(expired)} '{modality}' entries")
+            metrics.inc("expirations", len(expired))
+        await self._aremove(modality, remove)
 
 
     def get_all_embeddings(self, modality: Modality) -> List[EmbeddingData]:
-        raw = self.configs[modality].client.h_get_all(self._redis_key(modality))
-        return [EmbeddingData.parse_raw(v) for v in raw.values()]
+        pipe = self.configs[modality].client.pipeline(transaction=False)
+        pipe.h_get_all(self._redis_key(modality))
+        pipe.h_get_all(self._vector_key(modality))
+        raw, raw_vecs = pipe.execute()
+        return [self._parse_entry(v, raw_vecs.get(k)) for k, v in raw.items()]
+
+
+    def clear(self, modality: Modality) -> None:
+        cfg = self.configs[modality]
+        # same order as catch_up: sync lock, then write lock
+        with self._sync_locks[modality], self._write_locks[modality]:
+            pipe = cfg.client.pipeline()
+            pipe.delete(self._redis_key(modality))
+            pipe.delete(self._vector_key(modality))
+            pipe.delete(self._expiry_key(modality))
+            pipe.delete(self._usage_key(modality))
+            pipe.delete(self._log_key(modality))
+            # the id counter stays: other workers' indexes and reserved
+            # blocks still hold ids from it, and handing one out again would
+            # pair their old vector with a new prompt's answer. They drop
+            # their indexes when they replay this entry.
+            self._queue_log(pipe, modality, "clear", [])
+            pipe.execute()
+            self._reset_index(modality)
+            cfg.index_initialized = False
+            cfg.log_cursor = "0-0"
+            if cfg.snapshot_path:
+                for path in (cfg.snapshot_path, cfg.snapshot_path + ".json"):
+                    if os.path.exists(path):
+                        os.remove(path)
+
+
+    def _reset_index(self, modality: Modality) -> None:
+        """
+        Empty the local index, id block and L0 entries of `modality`, after
+        this or another worker cleared it.
+        """
+        cfg = self.configs[modality]
+        with self._write_locks[modality]:
+            cfg.ann_index.init_index(cfg.initial_size, cfg.embedding_size)
+        with self._id_lock:
+            cfg.current_id = 0
+            self._id_blocks[modality] = (0, 0)
+        with self._exact_lock:
+            keys = list(self._exact_keys[modality].values())
+            self._exact_keys[modality].clear()
+        for key in keys:
+            self.exact.pop(key)
+
+
+    def migrate_embeddings(self, modality: Modality, chunk_size: int = 500) -> int:
+        """
+        Rewrite entries that still store their embedding as a JSON float list
+        into metadata + packed vector. Safe to run repeatedly; returns the
+        number of entries migrated.
+        """
+        cfg = self.configs[modality]
+        key = self._redis_key(modality)
+        vec_key = self._vector_key(modality)
+
+        migrated = 0
+        cursor = 0
+        while True:
+            cursor, chunk = cfg.client.h_scan(key, cursor, chunk_size)
+            pipe = cfg.client.pipeline(transaction=False)
+            for field, meta_raw in chunk.items():
+                entry = EmbeddingData.model_validate_json(meta_raw)
+                if not entry.embedding:
+                    continue
+                pipe.h_set(vec_key, field, encode_embedding(entry.embedding, quantize=cfg.quantize_vectors))
+                pipe.h_set(key, field, entry.model_dump_json(exclude={"embedding"}))
+                if self.cache_ttl:
+                    pipe.z_add(self._expiry_key(modality), {field: entry.timestamp + self.cache_ttl})
+                pipe.z_add(self._usage_key(modality), {field: self._new_usage_score(cfg)})
+                migrated += 1
+            pipe.execute()
+            if cursor == 0:
+                break
+
+        logger.info(f"Migrated {migrated} '{modality}' entries to packed embeddings")
+        return migrated
@@ -1,18 +1,33 @@
 from abc import ABC, abstractmethod
+import threading
+import time
 import redis
+import redis.asyncio
 
 
 class CacheClient(ABC):
     @abstractmethod
-    def h_set(self, key: str, field: str, value: str) -> None:
+    def h_set(self, key: str, field: str, value: str | bytes) -> None:
         ...
 
     @abstractmethod
-    def hm_get(self, key: str, fields: list[str]) -> list[str | None]:
+    def hm_get(self, key: str, fields: list[str]) -> list[bytes | None]:
         ...
 
     @abstractmethod
-    def h_get_all(self, key: str) -> dict[str, str]:
+    def h_get_all(self, key: str) -> dict[bytes, bytes]:
+        ...
+
+    @abstractmethod
+    def h_keys(self, key: str) -> list[bytes]:
+        ...
+
+    @abstractmethod
+    def h_scan(self, key: str, cursor: int, count: int) -> tuple[int, dict[bytes, bytes]]:
+        """
+        One HSCAN step: returns the next cursor (0 when done) and roughly
+        `count` fields. Fields may repeat across steps.
+        """
         ...
 
     @abstractmethod
@@ -23,22 +38,550 @@ class CacheClient(ABC):
     def expire(self, key: str, seconds: int) -> None:
         ...
 
+    @abstractmethod
+    def h_del(self, key: str, fields: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        """
+        With `xx`, only update members that already exist (ZADD XX).
+        """
+        ...
+
+    @abstractmethod
+    def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        """
+        With `xx`, do nothing if `member` doesn't exist (ZADD XX INCR).
+        """
+        ...
+
+    @abstractmethod
+    def z_range(self, key: str, start: int, end: int) -> list[bytes]:
+        """
+        Members ranked start..end (inclusive) by ascending score.
+        """
+        ...
+
+    @abstractmethod
+    def z_range_by_score(self, key: str, min_score: float, max_score: float) -> list[bytes]:
+        ...
+
+    @abstractmethod
+    def z_rem(self, key: str, members: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    def z_card(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    def incr_by(self, key: str, amount: int) -> int:
+        """
+        Atomically add `amount` to an integer key and return the new value.
+        """
+        ...
+
+    @abstractmethod
+    def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        """
+        Append to a stream, trimming it to roughly `max_len` entries.
+        """
+        ...
+
+    @abstractmethod
+    def x_read(self, key: str, last_id: str, count: int) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        """
+        Up to `count` stream entries after `last_id`, without blocking.
+        """
+        ...
+
+    @abstractmethod
+    def x_last_id(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    def pipeline(self, transaction: bool = True) -> "CachePipeline":
+        """
+        Batch commands into one round trip. Commands on the returned object
+        are only queued, so their return values are meaningless; `execute`
+        sends them and returns their results in order. With `transaction`
+        they are applied atomically (MULTI/EXEC).
+        """
+        ...
+
+
+class CachePipeline(CacheClient):
+    @abstractmethod
+    def execute(self) -> list:
+        ...
+
 
 class RedisClient(CacheClient):
     def __init__(self, url: str):
         self.client = redis.Redis.from_url(url)
 
-    def h_set(self, key: str, field: str, value: str) -> None:
+    def h_set(self, key: str, field: str, value: str | bytes) -> None:
         self.client.hset(key, field, value)
 
-    def hm_get(self, key: str, fields: list[str]) -> list[str | None]:
+    def hm_get(self, key: str, fields: list[str]) -> list[bytes | None]:
         return self.client.hmget(key, fields)
 
-    def h_get_all(self, key: str) -> dict[str, str]:
+    def h_get_all(self, key: str) -> dict[bytes, bytes]:
         return self.client.hgetall(key)
 
+    def h_keys(self, key: str) -> list[bytes]:
+        return self.client.hkeys(key)
+
+    def h_scan(self, key: str, cursor: int, count: int) -> tuple[int, dict[bytes, bytes]]:
+        return self.client.hscan(key, cursor=cursor, count=count)
+
     def delete(self, key: str) -> None:
         self.client.delete(key)
 
     def expire(self, key: str, seconds: int) -> None:
         self.client.expire(key, seconds)
+
+    def h_del(self, key: str, fields: list[str]) -> None:
+        if fields:
+            self.client.hdel(key, *fields)
+
+    def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        self.client.zadd(key, mapping, xx=xx)
+
+    def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        if xx:
+            # ZINCRBY has no XX, ZADD's INCR form does
+            self.client.zadd(key, {member: amount}, xx=True, incr=True)
+        else:
+            self.client.zincrby(key, amount, member)
+
+    def z_range(self, key: str, start: int, end: int) -> list[bytes]:
+        return self.client.zrange(key, start, end)
+
+    def z_range_by_score(self, key: str, min_score: float, max_score: float) -> list[bytes]:
+        return self.client.zrangebyscore(key, min_score, max_score)
+
+    def z_rem(self, key: str, members: list[str]) -> None:
+        if members:
+            self.client.zrem(key, *members)
+
+    def z_card(self, key: str) -> int:
+        return self.client.zcard(key)
+
+    def incr_by(self, key: str, amount: int) -> int:
+        return self.client.incrby(key, amount)
+
+    def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        self.client.xadd(key, fields, maxlen=max_len, approximate=True)
+
+    def x_read(self, key: str, last_id: str, count: int) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        resp = self.client.xread({key: last_id}, count=count)
+        return resp[0][1] if resp else []
+
+    def x_last_id(self, key: str) -> bytes | None:
+        last = self.client.xrevrange(key, count=1)
+        return last[0][0] if last else None
+
+    def pipeline(self, transaction: bool = True) -> "RedisPipeline":
+        return RedisPipeline(self.client.pipeline(transaction=transaction))
+
+
+class RedisPipeline(RedisClient, CachePipeline):
+    # redis-py pipelines expose the same command methods, queueing instead
+    # of sending, so the RedisClient wrappers work on them unchanged
+    def __init__(self, pipe: redis.client.Pipeline):
+        self.client = pipe
+
+    def pipeline(self, transaction: bool = True) -> "RedisPipeline":
+        raise RuntimeError("Pipelines can't be nested")
+
+    def execute(self) -> list:
+        return self.client.execute()
+
+
+class AsyncCacheClient(ABC):
+    """
+    asyncio counterpart of CacheClient, same operations and return types.
+    """
+    @abstractmethod
+    async def h_set(self, key: str, field: str, value: str | bytes) -> None:
+        ...
+
+    @abstractmethod
+    async def hm_get(self, key: str, fields: list[str]) -> list[bytes | None]:
+        ...
+
+    @abstractmethod
+    async def h_get_all(self, key: str) -> dict[bytes, bytes]:
+        ...
+
+    @abstractmethod
+    async def h_keys(self, key: str) -> list[bytes]:
+        ...
+
+    @abstractmethod
+    async def h_scan(self, key: str, cursor: int, count: int) -> tuple[int, dict[bytes, bytes]]:
+        ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None:
+        ...
+
+    @abstractmethod
+    async def expire(self, key: str, seconds: int) -> None:
+        ...
+
+    @abstractmethod
+    async def h_del(self, key: str, fields: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    async def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        ...
+
+    @abstractmethod
+    async def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        ...
+
+    @abstractmethod
+    async def z_range(self, key: str, start: int, end: int) -> list[bytes]:
+        """
+        Members ranked start..end (inclusive) by ascending score.
+        """
+        ...
+
+    @abstractmethod
+    async def z_range_by_score(self, key: str, min_score: float, max_score: float) -> list[bytes]:
+        ...
+
+    @abstractmethod
+    async def z_rem(self, key: str, members: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    async def z_card(self, key: str) -> int:
+        ...
+
+    @abstractmethod
+    async def incr_by(self, key: str, amount: int) -> int:
+        ...
+
+    @abstractmethod
+    async def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        ...
+
+    @abstractmethod
+    async def x_read(self, key: str, last_id: str, count: int) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        ...
+
+    @abstractmethod
+    async def x_last_id(self, key: str) -> bytes | None:
+        ...
+
+    @abstractmethod
+    def pipeline(self, transaction: bool = True) -> "AsyncCachePipeline":
+        ...
+
+
+class AsyncCachePipeline(AsyncCacheClient):
+    @abstractmethod
+    async def execute(self) -> list:
+        ...
+
+
+class AsyncRedisClient(AsyncCacheClient):
+    def __init__(self, url: str):
+        self.client = redis.asyncio.Redis.from_url(url)
+
+    async def h_set(self, key: str, field: str, value: str | bytes) -> None:
+        await self.client.hset(key, field, value)
+
+    async def hm_get(self, key: str, fields: list[str]) -> list[bytes | None]:
+        return await self.client.hmget(key, fields)
+
+    async def h_get_all(self, key: str) -> dict[bytes, bytes]:
+        return await self.client.hgetall(key)
+
+    async def h_keys(self, key: str) -> list[bytes]:
+        return await self.client.hkeys(key)
+
+    async def h_scan(self, key: str, cursor: int, count: int) -> tuple[int, dict[bytes, bytes]]:
+        return await self.client.hscan(key, cursor=cursor, count=count)
+
+    async def delete(self, key: str) -> None:
+        await self.client.delete(key)
+
+    async def expire(self, key: str, seconds: int) -> None:
+        await self.client.expire(key, seconds)
+
+    async def h_del(self, key: str, fields: list[str]) -> None:
+        if fields:
+            await self.client.hdel(key, *fields)
+
+    async def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        await self.client.zadd(key, mapping, xx=xx)
+
+    async def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        if xx:
+            await self.client.zadd(key, {member: amount}, xx=True, incr=True)
+        else:
+            await self.client.zincrby(key, amount, member)
+
+    async def z_range(self, key: str, start: int, end: int) -> list[bytes]:
+        return await self.client.zrange(key, start, end)
+
+    async def z_range_by_score(self, key: str, min_score: float, max_score: float) -> list[bytes]:
+        return await self.client.zrangebyscore(key, min_score, max_score)
+
+    async def z_rem(self, key: str, members: list[str]) -> None:
+        if members:
+            await self.client.zrem(key, *members)
+
+    async def z_card(self, key: str) -> int:
+        return await self.client.zcard(key)
+
+    async def incr_by(self, key: str, amount: int) -> int:
+        return await self.client.incrby(key, amount)
+
+    async def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        await self.client.xadd(key, fields, maxlen=max_len, approximate=True)
+
+    async def x_read(self, key: str, last_id: str, count: int) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        resp = await self.client.xread({key: last_id}, count=count)
+        return resp[0][1] if resp else []
+
+    async def x_last_id(self, key: str) -> bytes | None:
+        last = await self.client.xrevrange(key, count=1)
+        return last[0][0] if last else None
+
+    def pipeline(self, transaction: bool = True) -> "AsyncRedisPipeline":
+        return AsyncRedisPipeline(self.client.pipeline(transaction=transaction))
+
+
+class AsyncRedisPipeline(AsyncRedisClient, AsyncCachePipeline):
+    # awaiting a queued command on a redis.asyncio pipeline just returns the
+    # pipeline, so the AsyncRedisClient wrappers queue as well
+    def __init__(self, pipe: redis.asyncio.client.Pipeline):
+        self.client = pipe
+
+    def pipeline(self, transaction: bool = True) -> "AsyncRedisPipeline":
+        raise RuntimeError("Pipelines can't be nested")
+
+    async def execute(self) -> list:
+        return await self.client.execute()
+
+
+def _to_bytes(value) -> bytes:
+    # Redis stores everything as bytes; mirror its str()/encode() coercion
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+def _stream_id(entry_id: str | bytes) -> tuple[int, int]:
+    ms, _, seq = _to_bytes(entry_id).partition(b"-")
+    return int(ms), int(seq or 0)
+
+
+class InMemoryCacheClient(CacheClient):
+    """
+    Process-local CacheClient backed by dicts, for tests and load tests that
+    shouldn't need a Redis server. Same return types as RedisClient, guarded
+    by one lock; pipelines apply atomically whether or not `transaction` is
+    set. Key expiry is checked lazily on access.
+    """
+    def __init__(self):
+        self._data: dict[str, object] = {}
+        self._expires: dict[str, float] = {}
+        self._stream_seq: dict[str, int] = {}
+        self._lock = threading.RLock()
+
+    def _get(self, key: str, default_factory=None):
+        deadline = self._expires.get(key)
+        if deadline is not None and time.time() >= deadline:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        if key not in self._data and default_factory is not None:
+            self._data[key] = default_factory()
+        return self._data.get(key)
+
+    def h_set(self, key: str, field: str, value: str | bytes) -> None:
+        with self._lock:
+            self._get(key, dict)[_to_bytes(field)] = _to_bytes(value)
+
+    def hm_get(self, key: str, fields: list[str]) -> list[bytes | None]:
+        with self._lock:
+            h = self._get(key) or {}
+            return [h.get(_to_bytes(f)) for f in fields]
+
+    def h_get_all(self, key: str) -> dict[bytes, bytes]:
+        with self._lock:
+            return dict(self._get(key) or {})
+
+    def h_keys(self, key: str) -> list[bytes]:
+        with self._lock:
+            return list(self._get(key) or {})
+
+    def h_scan(self, key: str, cursor: int, count: int) -> tuple[int, dict[bytes, bytes]]:
+        with self._lock:
+            items = list((self._get(key) or {}).items())
+        end = cursor + count
+        return (end if end < len(items) else 0), dict(items[cursor:end])
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+            # like Redis, a stream recreated after DEL gets ids above the old
+            # ones, so readers' cursors stay valid
+
+    def expire(self, key: str, seconds: int) -> None:
+        with self._lock:
+            if self._get(key) is not None:
+                self._expires[key] = time.time() + seconds
+
+    def h_del(self, key: str, fields: list[str]) -> None:
+        with self._lock:
+            h = self._get(key) or {}
+            for f in fields:
+                h.pop(_to_bytes(f), None)
+
+    def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        with self._lock:
+            z = self._get(key, dict)
+            for member, score in mapping.items():
+                m = _to_bytes(member)
+                if not xx or m in z:
+                    z[m] = float(score)
+
+    def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        with self._lock:
+            z = self._get(key, dict)
+            m = _to_bytes(member)
+            if not xx or m in z:
+                z[m] = z.get(m, 0.0) + amount
+
+    def _sorted_members(self, key: str) -> list[tuple[bytes, float]]:
+        return sorted((self._get(key) or {}).items(), key=lambda item: (item[1], item[0]))
+
+    def z_range(self, key: str, start: int, end: int) -> list[bytes]:
+        with self._lock:
+            members = self._sorted_members(key)
+        if end < 0:
+            end += len(members)
+        return [m for m, _ in members[start:end + 1]]
+
+    def z_range_by_score(self, key: str, min_score: float, max_score: float) -> list[bytes]:
+        with self._lock:
+            return [m for m, s in self._sorted_members(key) if min_score <= s <= max_score]
+
+    def z_rem(self, key: str, members: list[str]) -> None:
+        with self._lock:
+            z = self._get(key) or {}
+            for m in members:
+                z.pop(_to_bytes(m), None)
+
+    def z_card(self, key: str) -> int:
+        with self._lock:
+            return len(self._get(key) or {})
+
+    def incr_by(self, key: str, amount: int) -> int:
+        with self._lock:
+            value = int(self._get(key) or 0) + amount
+            self._data[key] = value
+            return value
+
+    def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        with self._lock:
+            stream = self._get(key, list)
+            seq = self._stream_seq.get(key, 0) + 1
+            self._stream_seq[key] = seq
+            stream.append((f"{seq}-0".encode(), {_to_bytes(k): _to_bytes(v) for k, v in fields.items()}))
+            del stream[:-max_len]
+
+    def x_read(self, key: str, last_id: str, count: int) -> list[tuple[bytes, dict[bytes, bytes]]]:
+        after = _stream_id(last_id)
+        with self._lock:
+            newer = [entry for entry in self._get(key) or [] if _stream_id(entry[0]) > after]
+        return newer[:count]
+
+    def x_last_id(self, key: str) -> bytes | None:
+        with self._lock:
+            stream = self._get(key) or []
+            return stream[-1][0] if stream else None
+
+    def pipeline(self, transaction: bool = True) -> "InMemoryPipeline":
+        return InMemoryPipeline(self)
+
+
+class InMemoryPipeline(CachePipeline):
+    # queues calls and replays them on the client under its lock
+    def __init__(self, client: InMemoryCacheClient):
+        self._client = client
+        self._queue: list[tuple[str, tuple]] = []
+
+    def _push(self, name: str, *args) -> None:
+        self._queue.append((name, args))
+
+    def h_set(self, key: str, field: str, value: str | bytes) -> None:
+        self._push("h_set", key, field, value)
+
+    def hm_get(self, key: str, fields: list[str]) -> None:
+        self._push("hm_get", key, fields)
+
+    def h_get_all(self, key: str) -> None:
+        self._push("h_get_all", key)
+
+    def h_keys(self, key: str) -> None:
+        self._push("h_keys", key)
+
+    def h_scan(self, key: str, cursor: int, count: int) -> None:
+        self._push("h_scan", key, cursor, count)
+
+    def delete(self, key: str) -> None:
+        self._push("delete", key)
+
+    def expire(self, key: str, seconds: int) -> None:
+        self._push("expire", key, seconds)
+
+    def h_del(self, key: str, fields: list[str]) -> None:
+        self._push("h_del", key, fields)
+
+    def z_add(self, key: str, mapping: dict[str, float], xx: bool = False) -> None:
+        self._push("z_add", key, mapping, xx)
+
+    def z_incr_by(self, key: str, member: str, amount: float, xx: bool = False) -> None:
+        self._push("z_incr_by", key, member, amount, xx)
+
+    def z_range(self, key: str, start: int, end: int) -> None:
+        self._push("z_range", key, start, end)
+
+    def z_range_by_score(self, key: str, min_score: float, max_score: float) -> None:
+        self._push("z_range_by_score", key, min_score, max_score)
+
+    def z_rem(self, key: str, members: list[str]) -> None:
+        self._push("z_rem", key, members)
+
+    def z_card(self, key: str) -> None:
+        self._push("z_card", key)
+
+    def incr_by(self, key: str, amount: int) -> None:
+        self._push("incr_by", key, amount)
+
+    def x_add(self, key: str, fields: dict[str, str], max_len: int) -> None:
+        self._push("x_add", key, fields, max_len)
+
+    def x_read(self, key: str, last_id: str, count: int) -> None:
+        self._push("x_read", key, last_id, count)
+
+    def x_last_id(self, key: str) -> None:
+        self._push("x_last_id", key)
+
+    def pipeline(self, transaction: bool = True) -> "InMemoryPipeline":
+        raise RuntimeError("Pipelines can't be nested")
+
+    def execute(self) -> list:
+        queue, self._queue = self._queue, []
+        with self._client._lock:
+            return [getattr(self._client, name)(*args) for name, args in queue]
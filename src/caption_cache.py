@@ -0,0 +1,47 @@
+from typing import List, Optional
+from .cache_client import CacheClient
+from .lru import LRUCache
+from .utils import logger
+
+
+class CaptionCache:
+    """
+    Memoizes image captions by a hash of the image bytes.
+
+    Lookups go to a bounded in-memory LRU first, then (if a client is
+    attached) to a Redis hash shared with other processes.
+    """
+    def __init__(
+        self,
+        max_size: int,
+        client: Optional[CacheClient] = None,
+        redis_key: str = "captions",
+    ):
+        self.memory: LRUCache[str] = LRUCache(max_size)
+        self.client = client
+        self.redis_key = redis_key
+
+    def attach(self, client: CacheClient, redis_key: str = "captions") -> None:
+        self.client = client
+        self.redis_key = redis_key
+
+    def get_many(self, digests: List[str]) -> List[Optional[str]]:
+        captions = [self.memory.get(d) for d in digests]
+
+        missing = [i for i, c in enumerate(captions) if c is None]
+        if missing and self.client is not None:
+            raw = self.client.hm_get(self.redis_key, [digests[i] for i in missing])
+            for i, item in zip(missing, raw):
+                if item is None:
+                    continue
+                caption = item.decode("utf-8") if isinstance(item, bytes) else item
+                self.memory.put(digests[i], caption)
+                captions[i] = caption
+
+        logger.debug(f"Caption cache: {len(digests) - captions.count(None)}/{len(digests)} hits")
+        return captions
+
+    def put(self, digest: str, caption: str) -> None:
+        self.memory.put(digest, caption)
+        if self.client is not None:
+            self.client.h_set(self.redis_key, digest, caption)
@@ -14,6 +14,24 @@ class Modality(Enum):
     IMAGE = "image"
     MULTIMODAL = "multimodal"
 
+class EvictionPolicy(Enum):
+    # least recently hit entries go first
+    LRU = "lru"
+    # least frequently hit entries go first
+    LFU = "lfu"
+
+class AnnIndexType(Enum):
+    # HNSW graph over float32 vectors
+    HNSW = "hnsw"
+    # flat scan over int8-quantized vectors, a quarter of the memory
+    INT8 = "int8"
+
+class EmbeddingMode(Enum):
+    # CLIP text/image features (or the embeddings API for text-only input)
+    SINGLESTEP = "singlestep"
+    # BLIP caption of the image, then a sentence embedding of prompt + caption
+    TWOSTEP = "twostep"
+
 
 @dataclass
 class GPTOptions:
@@ -30,6 +48,16 @@ class EmbeddingOptions:
     api_key: str
 
 
+@dataclass
+class HnswParams:
+    # graph degree: more links per node improve recall but cost memory and insert time
+    m: int = 16
+    # candidate list size while building the graph
+    ef_construction: int = 100
+    # candidate list size at query time; hnswlib never searches with less than k
+    ef: int = 50
+
+
 LLM_PROVIDER = Provider.OPENAI
 EMB_PROVIDER = Provider.OPENAI
 
@@ -38,11 +66,48 @@ LLM_MODEL = os.getenv("LLM_MODEL")
 EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL")
 OPENAI_KEY = os.getenv("OPENAI_API_KEY")
 OPENROUTER_KEY = os.getenv("OPENROUTER_API_KEY")
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+
+# shared HTTP client pools (LLM, embeddings and judge calls)
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "20"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "60"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
 
 TEXT_EMBEDDING_DIMENSION = int(os.getenv("TEXT_EMBEDDING_DIMENSION", "1536"))
 IMAGE_EMBEDDING_DIMENSION = int(os.getenv("IMAGE_EMBEDDING_DIMENSION", "512"))
 MULTIMODAL_EMBEDDING_DIMENSION = int(os.getenv("MULTIMODAL_EMBEDDING_DIMENSION", "768"))
 
+EMBEDDING_MODE = EmbeddingMode(os.getenv("EMBEDDING_MODE", "twostep"))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "32"))
+CAPTION_CACHE_SIZE = int(os.getenv("CAPTION_CACHE_SIZE", "10000"))
+
+# directory for ANN index snapshots; unset disables them
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR")
+
+# vector storage: index type, int8 vectors in Redis, and how many times k
+# candidates to re-rank at full precision when the index is quantized
+ANN_INDEX_TYPE = AnnIndexType(os.getenv("ANN_INDEX_TYPE", "hnsw"))
+QUANTIZE_VECTORS = os.getenv("QUANTIZE_VECTORS", "false").lower() == "true"
+RERANK_FACTOR = int(os.getenv("RERANK_FACTOR", "4"))
+
+# per-modality cap on cached entries; 0 means unbounded
+MAX_CACHE_ENTRIES = int(os.getenv("MAX_CACHE_ENTRIES", "0"))
+EVICTION_POLICY = EvictionPolicy(os.getenv("EVICTION_POLICY", "lru"))
+
+# recall@THRESHOLD that EmbeddingCache.tune_ef aims for
+TARGET_RECALL = float(os.getenv("TARGET_RECALL", "0.95"))
+
+# per-stage timings, hit/miss counters and histograms (src/metrics.py)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() == "true"
+
+# SimilarityScorer: text pairs judged per chat request, how long (seconds)
+# a pair waits for other threads' pairs to fill a request, and how many
+# embeddings and judge scores it memoizes
+JUDGE_PAIRS_PER_REQUEST = int(os.getenv("JUDGE_PAIRS_PER_REQUEST", "1"))
+JUDGE_BATCH_WAIT = float(os.getenv("JUDGE_BATCH_WAIT", "0.05"))
+JUDGE_MEMO_SIZE = int(os.getenv("JUDGE_MEMO_SIZE", "10000"))
+
 THRESHOLD = int(os.getenv("THRESHOLD", "5"))
 SIMILARITY_THRESHOLD = float(os.getenv("SIMILARITY_THRESHOLD", "0.7"))
 
@@ -61,3 +126,27 @@ emb_opts = EmbeddingOptions(
     provider=EMB_PROVIDER,
     api_key=emb_key
 )
+
+
+def snapshot_path(modality: Modality) -> str | None:
+    if not SNAPSHOT_DIR:
+        return None
+    # each index type has its own snapshot, so switching ANN_INDEX_TYPE
+    # doesn't overwrite the other's
+    return os.path.join(SNAPSHOT_DIR, f"{modality.value}.{ANN_INDEX_TYPE.value}")
+
+
+def hnsw_params(modality: Modality) -> HnswParams:
+    """
+    HNSW parameters for `modality`, e.g. TEXT_HNSW_EF, falling back to the
+    shared HNSW_M / HNSW_EF_CONSTRUCTION / HNSW_EF and then the defaults.
+    """
+    defaults = HnswParams()
+    def get(name: str, default: int) -> int:
+        return int(os.getenv(f"{modality.name}_HNSW_{name}", os.getenv(f"HNSW_{name}", default)))
+
+    return HnswParams(
+        m=get("M", defaults.m),
+        ef_construction=get("EF_CONSTRUCTION", defaults.ef_construction),
+        ef=get("EF", defaults.ef),
+    )
@@ -6,6 +6,15 @@ class EmbeddingData(BaseModel):
     id: int
     query: str
     image: str = ""
-    embedding: List[float]
+    embedding: List[float] = []
     response: str
     timestamp: int
+
+
+class SearchResult(BaseModel):
+    entry: EmbeddingData
+    # cosine similarity to the query, from the ANN index distance
+    similarity: float
+    # per-half scores, see similarity.score_candidates
+    text_score: float
+    image_score: float
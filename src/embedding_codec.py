@@ -0,0 +1,54 @@
+import numpy as np
+from typing import Sequence, Tuple
+
+# Layout of a stored embedding: 1 version byte, then
+#   1: the vector as little-endian float32
+#   2: a little-endian float32 scale, then the vector as int8 codes
+#      (int8 scalar quantization, value ~= code * scale)
+# Bump the version when the layout changes and keep decoding the old ones.
+EMBEDDING_FORMAT_VERSION = 1
+INT8_FORMAT_VERSION = 2
+_FLOAT32_LE = np.dtype("<f4")
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-row int8 quantization of a (n, d) matrix: returns the
+    codes and one float32 scale per row.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=-1) / 127
+    safe = np.where(scales == 0, 1, scales)
+    codes = np.clip(np.rint(vectors / safe[..., None]), -127, 127).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * np.asarray(scales, dtype=np.float32)[..., None]
+
+
+def encode_embedding(embedding: Sequence[float], quantize: bool = False) -> bytes:
+    """
+    Pack an embedding for storage; `quantize` stores int8 codes, a quarter
+    of the float32 size, at some loss of precision.
+    """
+    vec = np.asarray(embedding, dtype=_FLOAT32_LE)
+    if not quantize:
+        return bytes([EMBEDDING_FORMAT_VERSION]) + vec.tobytes()
+
+    codes, scale = quantize_int8(vec)
+    return bytes([INT8_FORMAT_VERSION]) + scale.astype(_FLOAT32_LE).tobytes() + codes.tobytes()
+
+
+def decode_embedding(raw: bytes) -> np.ndarray:
+    if not raw:
+        raise ValueError("Empty embedding payload")
+
+    version = raw[0]
+    if version == EMBEDDING_FORMAT_VERSION:
+        return np.frombuffer(raw, dtype=_FLOAT32_LE, offset=1)
+    if version == INT8_FORMAT_VERSION:
+        scale = np.frombuffer(raw, dtype=_FLOAT32_LE, count=1, offset=1)[0]
+        codes = np.frombuffer(raw, dtype=np.int8, offset=5)
+        return codes.astype(np.float32) * scale
+    raise ValueError(f"Unknown embedding format version: {version}")
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import weakref
+from typing import Dict
+
+import httpx
+import requests
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from .config import HTTP_BACKOFF, HTTP_MAX_RETRIES, HTTP_POOL_SIZE, HTTP_TIMEOUT, OPENAI_BASE_URL
+
+# Process-wide HTTP clients. Each keeps a keep-alive connection pool, so
+# repeated calls reuse connections instead of paying for a new TLS
+# handshake every time.
+
+_lock = threading.Lock()
+_openai_clients: Dict[str, OpenAI] = {}
+# httpx async clients are tied to the event loop they were first used on
+_async_openai_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, AsyncOpenAI]]" = (
+    weakref.WeakKeyDictionary()
+)
+_session: requests.Session | None = None
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=HTTP_POOL_SIZE, max_keepalive_connections=HTTP_POOL_SIZE)
+
+
+def get_openai_client(api_key: str) -> OpenAI:
+    with _lock:
+        client = _openai_clients.get(api_key)
+        if client is None:
+            client = OpenAI(
+                api_key=api_key,
+                base_url=OPENAI_BASE_URL,
+                timeout=HTTP_TIMEOUT,
+                max_retries=HTTP_MAX_RETRIES,
+                http_client=DefaultHttpxClient(limits=_limits()),
+            )
+            _openai_clients[api_key] = client
+        return client
+
+
+def get_async_openai_client(api_key: str) -> AsyncOpenAI:
+    loop = asyncio.get_running_loop()
+    with _lock:
+        clients = _async_openai_clients.setdefault(loop, {})
+        client = clients.get(api_key)
+        if client is None:
+            client = AsyncOpenAI(
+                api_key=api_key,
+                base_url=OPENAI_BASE_URL,
+                timeout=HTTP_TIMEOUT,
+                max_retries=HTTP_MAX_RETRIES,
+                http_client=DefaultAsyncHttpxClient(limits=_limits()),
+            )
+            clients[api_key] = client
+        return client
+
+
+def get_session() -> requests.Session:
+    """
+    Shared requests session for raw HTTP calls (e.g. the embeddings endpoint),
+    with retries and exponential backoff on rate limits and server errors.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            retry = Retry(
+                total=HTTP_MAX_RETRIES,
+                backoff_factor=HTTP_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504),
+                # the embeddings API is a POST, which urllib3 won't retry by default
+                allowed_methods=None,
+                # hand the last error response back, so callers' raise_for_status
+                # raises HTTPError rather than urllib3 raising RetryError
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _session = session
+        return _session
@@ -1,61 +1,249 @@
-from openai import OpenAI
-from src.config import GPTOptions, EmbeddingOptions
-from src.api import singlestep_get_embedding, LLMInput
-from math import sqrt
+import re
+import threading
+import numpy as np
+from concurrent.futures import Future, TimeoutError
+from typing import Dict, List, Optional, Sequence, Tuple
+from src.config import (
+    GPTOptions, EmbeddingOptions, EMBEDDING_BATCH_SIZE, JUDGE_BATCH_WAIT, JUDGE_MEMO_SIZE, JUDGE_PAIRS_PER_REQUEST,
+)
+from src.api import embed_inputs, LLMInput
+from src.http_clients import get_openai_client
+from src.lru import LRUCache
+from src.metrics import metrics
+from src.rate_limit import RateLimiter
+from src.similarity import normalize_rows
+from src.utils import hash_bytes, logger
 
 MAX_SCORE = 100
 
+SYSTEM_PROMPT = (
+    "You are a semantic similarity evaluator. "
+    "Given two texts, compute how semantically similar they are on a scale from 0 to 100, "
+    "where 0 means completely unrelated and 100 means identical in meaning. "
+    "Respond in the following format XX.YY;<REASON>, where <REASON> should be replaced with a short scoring rationale."
+)
+BATCH_SYSTEM_PROMPT = (
+    "You are a semantic similarity evaluator. "
+    "Given numbered pairs of texts, compute for each pair how semantically similar its two texts are "
+    "on a scale from 0 to 100, where 0 means completely unrelated and 100 means identical in meaning. "
+    "Score every pair on its own, without comparing it to the other pairs. "
+    "Respond with one line per pair in the following format N: XX.YY;<REASON>, where N is the pair number "
+    "and <REASON> should be replaced with a short scoring rationale."
+)
+# "N: XX.YY;" at the start of a line of a batched answer; models also write
+# "Pair N:", "N." or "N)". A "." label needs a space after it so a bare
+# "85.00;" isn't read as pair 85.
+_BATCH_LINE = re.compile(
+    r"^\s*(?:pair\s*)?(\d+)\s*(?::|\)|\.(?=\s))\s*(\d+(?:\.\d+)?)\s*;",
+    re.MULTILINE | re.IGNORECASE,
+)
+
+
 class SimilarityScorer:
-    def __init__(self, gpt_options: GPTOptions, embedding_options: EmbeddingOptions):
-        self.client = OpenAI(api_key=gpt_options.api_key)
+    """
+    LLM-as-a-judge and embedding similarity between pairs of texts. Text
+    embeddings and judge scores are memoized by text hash, so a text or pair
+    seen before costs no request. With `pairs_per_request` > 1 the judge
+    scores that many pairs per chat completion, pooling the pairs of
+    callers on different threads: a pair waits up to `batch_wait` seconds
+    for others to fill a request before it is sent with whatever is
+    queued. `limiter`, if given, is acquired before every request.
+    """
+    def __init__(
+        self,
+        gpt_options: GPTOptions,
+        embedding_options: EmbeddingOptions,
+        pairs_per_request: int = JUDGE_PAIRS_PER_REQUEST,
+        memo_size: int = JUDGE_MEMO_SIZE,
+        limiter: Optional[RateLimiter] = None,
+        batch_wait: float = JUDGE_BATCH_WAIT,
+    ):
+        self.client = get_openai_client(gpt_options.api_key)
         self.model = gpt_options.model
         self.embedding_options = embedding_options
+        self.pairs_per_request = pairs_per_request
+        self.batch_wait = batch_wait
+        self.limiter = limiter
+        self._embeddings: LRUCache[np.ndarray] = LRUCache(memo_size)
+        self._scores: LRUCache[float] = LRUCache(memo_size)
+        # pairs waiting for a batched request, with the futures their callers wait on
+        self._queue: List[Tuple[Tuple[str, str], Future]] = []
+        self._queue_lock = threading.Lock()
 
-    def similarity_score(self, text_a: str, text_b: str) -> float:
-        """
-        Returns a similarity score between 0 (no similarity) and 100 (identical) for text_a and text_b.
-        """
-        system_message = {
-            "role": "system",
-            "content": (
-                "You are a semantic similarity evaluator. "
-                "Given two texts, compute how semantically similar they are on a scale from 0 to 100, "
-                "where 0 means completely unrelated and 100 means identical in meaning. "
-                "Respond in the following format XX.YY;<REASON>, where <REASON> should be replaced with a short scoring rationale."
-            )
-        }
-        user_message = {
-            "role": "user",
-            "content": (
-                f"Text A:\n{text_a}\n\n"
-                f"Text B:\n{text_b}\n\n"
-                "Please provide the similarity score."
-            )
-        }
+    @staticmethod
+    def _text_key(text: str) -> str:
+        return hash_bytes(text.encode())
 
+    def _pair_key(self, text_a: str, text_b: str) -> Tuple[str, str]:
+        return self._text_key(text_a), self._text_key(text_b)
+
+    def _acquire(self) -> None:
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+    def _complete(self, system: str, user: str) -> str:
+        self._acquire()
         completion = self.client.chat.completions.create(
             model=self.model,
-            messages=[system_message, user_message],
+            messages=[{"role": "system", "content": system}, {"role": "user", "content": user}],
             temperature=0,
             top_p=1,
         )
-        content = completion.choices[0].message.content.strip()
+        return completion.choices[0].message.content.strip()
+
+    def _score_pair(self, text_a: str, text_b: str) -> float:
+        content = self._complete(
+            SYSTEM_PROMPT,
+            f"Text A:\n{text_a}\n\n"
+            f"Text B:\n{text_b}\n\n"
+            "Please provide the similarity score.",
+        )
         score, _ = content.split(";", 1)
         return float(score.strip())/MAX_SCORE
-    
+
+    def _score_batch(self, pairs: Sequence[Tuple[str, str]]) -> Dict[int, float]:
+        """
+        Scores by position in `pairs`, for the pairs the answer covered.
+        """
+        numbered = "\n\n".join(
+            f"Pair {n}:\nText A:\n{text_a}\n\nText B:\n{text_b}"
+            for n, (text_a, text_b) in enumerate(pairs, 1)
+        )
+        content = self._complete(BATCH_SYSTEM_PROMPT, f"{numbered}\n\nPlease provide the similarity scores.")
+        scores = {}
+        for n, score in _BATCH_LINE.findall(content):
+            if 1 <= int(n) <= len(pairs):
+                scores[int(n) - 1] = float(score)/MAX_SCORE
+        return scores
+
+    def _send(self, queued: List[Tuple[Tuple[str, str], Future]]) -> None:
+        """
+        Score queued pairs in requests of up to `pairs_per_request` and
+        resolve their futures. Pairs missing from a batched answer are asked
+        again on their own.
+        """
+        for start in range(0, len(queued), self.pairs_per_request):
+            chunk = queued[start:start + self.pairs_per_request]
+            try:
+                batch = self._score_batch([pair for pair, _ in chunk]) if len(chunk) > 1 else {}
+                if len(chunk) > 1 and len(batch) < len(chunk):
+                    logger.debug(f"Judge answered {len(batch)} of {len(chunk)} pairs, scoring the rest one by one")
+                for i, (pair, future) in enumerate(chunk):
+                    future.set_result(batch[i] if i in batch else self._score_pair(*pair))
+            except BaseException as e:
+                for _, future in chunk:
+                    if not future.done():
+                        future.set_exception(e)
+                if not isinstance(e, Exception):
+                    raise
+
+    def _take_queue(self, full_only: bool) -> List[Tuple[Tuple[str, str], Future]]:
+        # callers hold _queue_lock
+        if full_only:
+            n = len(self._queue) - len(self._queue) % self.pairs_per_request
+        else:
+            n = len(self._queue)
+        queued, self._queue = self._queue[:n], self._queue[n:]
+        return queued
+
+    def _score_pooled(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        futures = [Future() for _ in pairs]
+        with self._queue_lock:
+            self._queue.extend(zip(pairs, futures))
+            full = self._take_queue(full_only=True)
+        # whoever fills a request sends it
+        self._send(full)
+
+        try:
+            scores = [future.result(timeout=self.batch_wait) for future in futures]
+        except TimeoutError:
+            # not enough company; send what's queued (ours, unless another
+            # caller already took it) and wait for our pairs to be scored
+            with self._queue_lock:
+                rest = self._take_queue(full_only=False)
+            self._send(rest)
+            scores = [future.result() for future in futures]
+        return scores
+
+    def similarity_score(self, text_a: str, text_b: str) -> float:
+        """
+        Returns a similarity score between 0 (no similarity) and 1 (identical) for text_a and text_b.
+        """
+        return self.similarity_scores([(text_a, text_b)])[0]
+
+    def similarity_scores(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        """
+        `similarity_score` for every pair, batched with other threads' pairs
+        when `pairs_per_request` > 1.
+        """
+        keys = [self._pair_key(a, b) for a, b in pairs]
+        scores: Dict[Tuple[str, str], float] = {}
+        todo: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        for key, pair in zip(keys, pairs):
+            if key in scores or key in todo:
+                continue
+            cached = self._scores.get(key)
+            if cached is not None:
+                scores[key] = cached
+            else:
+                todo[key] = pair
+
+        if self.pairs_per_request > 1 and todo:
+            new = self._score_pooled(list(todo.values()))
+        else:
+            new = [self._score_pair(text_a, text_b) for text_a, text_b in todo.values()]
+        for key, score in zip(todo, new):
+            scores[key] = score
+            self._scores.put(key, score)
+        return [scores[key] for key in keys]
+
+    def embed_texts(self, texts: Sequence[str]) -> np.ndarray:
+        """
+        Unit-length embeddings of `texts`, one row each. Texts not memoized
+        yet are embedded together, one request per EMBEDDING_BATCH_SIZE.
+        """
+        keys = [self._text_key(t) for t in texts]
+        vecs: Dict[str, np.ndarray] = {}
+        todo: Dict[str, str] = {}
+        for key, text in zip(keys, texts):
+            if key in vecs or key in todo:
+                continue
+            cached = self._embeddings.get(key)
+            if cached is not None:
+                vecs[key] = cached
+            else:
+                todo[key] = text
+
+        items = list(todo.items())
+        # embed_inputs sends one request per EMBEDDING_BATCH_SIZE inputs;
+        # split here so each of them takes its own limiter token. Timed as
+        # "judge_embed" so the "embed" stage stays query embeddings only.
+        for start in range(0, len(items), EMBEDDING_BATCH_SIZE):
+            chunk = items[start:start + EMBEDDING_BATCH_SIZE]
+            self._acquire()
+            with metrics.stage("judge_embed"):
+                embs = embed_inputs([LLMInput(text=t) for _, t in chunk], self.embedding_options)
+            rows = normalize_rows(np.asarray([emb for emb, _ in embs], dtype=np.float32))
+            for (key, _), row in zip(chunk, rows):
+                vecs[key] = row
+                self._embeddings.put(key, row)
+
+        if not keys:
+            return np.empty((0, 0), dtype=np.float32)
+        return np.stack([vecs[key] for key in keys])
+
     def embeddings_similarity(self, text_a: str, text_b: str) -> float:
-        # Compute cosine similarity
-        a = LLMInput(text=text_a)
-        b = LLMInput(text=text_b)
-        emb_a = singlestep_get_embedding(a, self.embedding_options)[0]
-        emb_b = singlestep_get_embedding(b, self.embedding_options)[0]
-
-        dot = sum(x * y for x, y in zip(emb_a, emb_b))
-        norm_a = sqrt(sum(x * x for x in emb_a))
-        norm_b = sqrt(sum(y * y for y in emb_b))
-        if norm_a == 0 or norm_b == 0:
-            return 0.0
-        return dot / (norm_a * norm_b)
+        return self.embeddings_similarities([(text_a, text_b)])[0]
+
+    def embeddings_similarities(self, pairs: Sequence[Tuple[str, str]]) -> List[float]:
+        """
+        Cosine similarity for every pair, from one embedding call for all
+        their texts. Zero vectors score 0.
+        """
+        if not pairs:
+            return []
+        embs = self.embed_texts([text for pair in pairs for text in pair])
+        return np.einsum("ij,ij->i", embs[0::2], embs[1::2]).tolist()
 
 if __name__ == "__main__":
     import os
@@ -0,0 +1,180 @@
+import asyncio
+import bisect
+import contextvars
+import functools
+import time
+from contextlib import contextmanager, nullcontext
+from threading import Lock
+from typing import Callable, Dict, Optional, Sequence
+from .config import METRICS_ENABLED
+
+# histogram bucket upper bounds, in ms
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# stage -> ms for the query currently running in this context, if it's traced
+_trace: contextvars.ContextVar[Optional[Dict[str, float]]] = contextvars.ContextVar("trace", default=None)
+
+_NOOP = nullcontext()
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Quantiles are estimated as the upper bound of
+    the bucket they fall in (the max for the overflow bucket).
+    """
+    def __init__(self, bounds: Sequence[float] = BUCKETS_MS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self._lock = Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self.bounds, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q: float) -> float:
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+        return 0.0
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "mean": self.sum / self.count if self.count else 0.0,
+                "max": self.max,
+                "p50": self.quantile(0.5),
+                "p95": self.quantile(0.95),
+                "p99": self.quantile(0.99),
+                "buckets": dict(zip([*map(str, self.bounds), "inf"], self.counts)),
+            }
+
+
+class Metrics:
+    """
+    Process-wide counters, histograms and gauges, plus per-query stage
+    timings. Every entry point returns immediately when `enabled` is False,
+    so instrumented code pays one attribute check.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._counters: Dict[str, int] = {}
+        self._histograms: Dict[str, Histogram] = {}
+        # read when a snapshot is taken, never on the hot path
+        self._gauges: Dict[str, Callable[[], float]] = {}
+        self._lock = Lock()
+
+    def inc(self, name: str, amount: int = 1) -> None:
+        if not self.enabled or not amount:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def observe(self, name: str, value: float) -> None:
+        if not self.enabled:
+            return
+        hist = self._histograms.get(name)
+        if hist is None:
+            with self._lock:
+                hist = self._histograms.setdefault(name, Histogram())
+        hist.observe(value)
+
+    def register_gauge(self, name: str, fn: Callable[[], float], labels: Optional[Dict[str, str]] = None) -> None:
+        """
+        Read `fn` into every snapshot as `name`, or as `name{k=v,...}` with
+        `labels`, so gauges of several instances don't replace each other.
+        """
+        if labels:
+            name = f"{name}{{{','.join(f'{k}={v}' for k, v in sorted(labels.items()))}}}"
+        with self._lock:
+            self._gauges[name] = fn
+
+    def _record(self, name: str, ms: float) -> None:
+        self.observe(f"{name}_ms", ms)
+        timings = _trace.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + ms
+
+    @contextmanager
+    def _stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(name, 1000 * (time.perf_counter() - start))
+
+    def stage(self, name: str):
+        """
+        Time a block as stage `name`: observed into the `<name>_ms` histogram
+        and added to the current query's timings.
+        """
+        return self._stage(name) if self.enabled else _NOOP
+
+    def timed(self, name: str):
+        """
+        Decorator form of `stage`, for plain and async functions.
+        """
+        def decorate(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.stage(name):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorate
+
+    @contextmanager
+    def trace(self):
+        """
+        Collect stage timings (ms) for one query into the yielded dict, plus
+        its "total". Yields an empty dict and records nothing when disabled.
+        """
+        timings: Dict[str, float] = {}
+        if not self.enabled:
+            yield timings
+            return
+
+        token = _trace.set(timings)
+        start = time.perf_counter()
+        try:
+            yield timings
+        finally:
+            _trace.reset(token)
+            timings["total"] = 1000 * (time.perf_counter() - start)
+            self.observe("query_ms", timings["total"])
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = dict(self._histograms)
+            gauges = dict(self._gauges)
+        return {
+            "counters": counters,
+            "gauges": {name: fn() for name, fn in gauges.items()},
+            "histograms": {name: hist.snapshot() for name, hist in histograms.items()},
+        }
+
+    def reset(self) -> None:
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+
+metrics = Metrics(enabled=METRICS_ENABLED)
@@ -0,0 +1,31 @@
+import time
+from threading import Lock
+
+
+class RateLimiter:
+    """
+    Token bucket shared between threads: `acquire` blocks until a call is
+    allowed, so calls go out at `rate` per second on average with bursts of
+    at most `burst`. A rate of 0 or less never blocks.
+    """
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
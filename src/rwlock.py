@@ -0,0 +1,48 @@
+from contextlib import contextmanager
+from threading import Condition, Lock
+
+
+class RWLock:
+    """
+    Any number of readers or a single writer. Writers take precedence: once
+    one is waiting, new readers queue behind it, so a steady stream of
+    reads can't keep it out for longer than the reads already running.
+    The flip side is that it isn't reentrant at all: a thread that takes
+    `read()` again while a writer waits deadlocks.
+    """
+    def __init__(self):
+        self._cond = Condition(Lock())
+        self._readers = 0
+        self._writers_waiting = 0
+        self._writing = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writing or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            self._writers_waiting += 1
+            try:
+                while self._writing or self._readers:
+                    self._cond.wait()
+            finally:
+                self._writers_waiting -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
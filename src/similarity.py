@@ -1,6 +1,11 @@
-from typing import List
+import numpy as np
+from typing import List, Sequence
 from src.config import Modality
 
+# Score reported for the image half of text-only queries, so a text hit
+# only has to clear the threshold on its text score.
+NO_IMAGE_SCORE = 100
+
 
 def cosine_similarity(modality: Modality, a: List[float], b: List[float]) -> float:
     if len(a) != len(b):
@@ -14,23 +19,52 @@ def cosine_similarity(modality: Modality, a: List[float], b: List[float]) -> flo
         
 
 def text_cosine_similarity(a: List[float], b: List[float]) -> float:
-    dot = sum(x * y for x, y in zip(a, b))
-    na = sum(x * x for x in a) ** 0.5
-    nb = sum(y * y for y in b) ** 0.5
-    return [dot / (na * nb), 100]
+    return score_candidates(Modality.TEXT, a, [b])[0].tolist()
 
 def multimodal_cosine_similarity(a: List[float], b: List[float]) -> float:
-    shift = len(a) // 2
-    text_dot = sum(x * y for x, y in zip(a[:shift], b[:shift]))
-    image_dot = sum(x * y for x, y in zip(a[shift:], b[shift:]))
+    return score_candidates(Modality.MULTIMODAL, a, [b])[0].tolist()
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    return np.divide(matrix, norms, out=np.zeros_like(matrix), where=norms != 0)
+
+
+def _cosine(query: np.ndarray, candidates: np.ndarray, normalized: bool) -> np.ndarray:
+    if not normalized:
+        query = normalize_rows(query)
+        candidates = normalize_rows(candidates)
+    return candidates @ query
 
-    text_na = sum(x * x for x in a[:shift]) ** 0.5
-    text_nb = sum(y * y for y in b[:shift]) ** 0.5
 
-    image_na = sum(x * x for x in a[shift:]) ** 0.5
-    image_nb = sum(y * y for y in b[shift:]) ** 0.5
+def score_candidates(
+    modality: Modality,
+    query: Sequence[float],
+    candidates: Sequence[Sequence[float]] | np.ndarray,
+    normalized: bool = False,
+) -> np.ndarray:
+    """
+    Scores `query` against every row of `candidates` in one pass.
 
-    text_cosine_similarity = text_dot / (text_na * text_nb)
-    image_cosine_similarity = image_dot / (image_na * image_nb)
+    Returns an (n, 2) array of (text_score, image_score) per candidate. For
+    multimodal vectors the two halves are compared separately; for text the
+    image score is NO_IMAGE_SCORE. `normalized` means both the query and the
+    candidate rows already have unit length, which skips the norms for text.
+    """
+    q = np.asarray(query, dtype=np.float32)
+    m = np.asarray(candidates, dtype=np.float32).reshape(-1, q.shape[0])
+    scores = np.empty((m.shape[0], 2), dtype=np.float32)
+
+    if modality == Modality.TEXT:
+        scores[:, 0] = _cosine(q, m, normalized)
+        scores[:, 1] = NO_IMAGE_SCORE
+        return scores
+
+    if modality == Modality.MULTIMODAL:
+        # unit length overall doesn't make each half unit length
+        shift = q.shape[0] // 2
+        scores[:, 0] = _cosine(q[:shift], m[:, :shift], normalized=False)
+        scores[:, 1] = _cosine(q[shift:], m[:, shift:], normalized=False)
+        return scores
 
-    return [text_cosine_similarity, image_cosine_similarity]
\ No newline at end of file
+    raise ValueError(f"Unsupported modality: {modality}")
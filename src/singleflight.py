@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import numpy as np
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Tuple
+from .config import Modality
+from .similarity import score_candidates
+
+
+@dataclass
+class PendingCall:
+    modality: Modality
+    embedding: np.ndarray
+    future: Future = field(default_factory=Future)
+
+    def wait(self, timeout: Optional[float] = None) -> str:
+        return self.future.result(timeout)
+
+    async def await_result(self) -> str:
+        # no thread is parked per waiter, the loop is woken on completion
+        return await asyncio.wrap_future(self.future)
+
+
+class SingleFlight:
+    """
+    Tracks cache misses whose LLM call is still running, so concurrent
+    callers with the same (or a semantically close) prompt wait for that
+    call instead of making their own.
+
+    The first caller for a key becomes the leader and must call `finish`.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[str, PendingCall] = {}
+
+    def find(self, key: str) -> Optional[PendingCall]:
+        with self._lock:
+            return self._pending.get(key)
+
+    def join(
+        self,
+        key: str,
+        modality: Modality,
+        embedding: List[float],
+        sim_threshold: Optional[float] = None,
+    ) -> Tuple[PendingCall, bool]:
+        """
+        Returns (call, is_leader). Followers match on `key`, or, when
+        `sim_threshold` is given, on a pending embedding that clears it.
+        """
+        with self._lock:
+            call = self._pending.get(key)
+            if call is not None:
+                return call, False
+
+            if sim_threshold is not None:
+                call = self._nearest(modality, embedding, sim_threshold)
+                if call is not None:
+                    return call, False
+
+            call = PendingCall(modality=modality, embedding=np.asarray(embedding, dtype=np.float32))
+            self._pending[key] = call
+            return call, True
+
+    def finish(self, key: str, result: Optional[str] = None, error: Optional[BaseException] = None) -> None:
+        with self._lock:
+            call = self._pending.pop(key, None)
+        if call is None:
+            return
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def _nearest(self, modality: Modality, embedding: List[float], sim_threshold: float) -> Optional[PendingCall]:
+        calls = [c for c in self._pending.values() if c.modality == modality]
+        if not calls:
+            return None
+
+        scores = score_candidates(modality, embedding, np.stack([c.embedding for c in calls]))
+        best, best_score = None, None
+        for call, (text_score, image_score) in zip(calls, scores.tolist()):
+            if text_score > sim_threshold and image_score > sim_threshold:
+                score = text_score**2 + image_score**2
+                if best_score is None or score > best_score:
+                    best, best_score = call, score
+        return best
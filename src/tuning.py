@@ -0,0 +1,95 @@
+from dataclasses import dataclass
+import numpy as np
+import time
+from typing import List, Sequence
+from .ann_index import ANNIndex
+from .similarity import normalize_rows
+from .utils import logger
+
+# ef values tried by tune_ef, smallest first
+EF_CANDIDATES = (10, 16, 24, 32, 48, 64, 96, 128, 192, 256, 384, 512)
+
+
+@dataclass
+class EfTrial:
+    ef: int
+    # mean recall@k over the sampled queries
+    recall: float
+    # mean search time per query
+    latency_ms: float
+
+
+@dataclass
+class EfTuning:
+    ef: int
+    target_recall: float
+    met_target: bool
+    trials: List[EfTrial]
+
+
+def exact_knn(points: np.ndarray, queries: np.ndarray, k: int, exclude: np.ndarray, chunk_size: int = 64) -> np.ndarray:
+    """
+    Row i holds the positions in `points` of the k unit vectors most similar
+    to queries[i], skipping position exclude[i] (the query itself).
+    """
+    out = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), chunk_size):
+        sims = queries[start:start + chunk_size] @ points.T
+        rows = np.arange(len(sims))
+        sims[rows, exclude[start:start + chunk_size]] = -np.inf
+        top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+        out[start:start + len(sims)] = top
+    return out
+
+
+def tune_ef(
+    index: ANNIndex,
+    k: int,
+    target_recall: float,
+    sample_size: int = 200,
+    candidates: Sequence[int] = EF_CANDIDATES,
+    seed: int = 0,
+) -> EfTuning:
+    """
+    Pick the smallest ef whose recall@k meets `target_recall`, measured by
+    querying the index with a sample of its own points and comparing against
+    exact search (the query point itself is left out of both). The chosen ef
+    is applied to the index; if no candidate meets the target, the one with
+    the best recall is. Live searches run at each trial ef while this runs.
+    """
+    ids = np.asarray(index.get_ids())
+    if len(ids) <= k:
+        # every search already returns everything
+        return EfTuning(ef=index.get_ef(), target_recall=target_recall, met_target=True, trials=[])
+
+    points = np.asarray(index.get_pts(ids.tolist()), dtype=np.float32)
+    if not index.normalized:
+        points = normalize_rows(points)
+
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(len(ids), size=min(sample_size, len(ids)), replace=False)
+    queries = points[sample]
+    truth = [set(row) for row in ids[exact_knn(points, queries, k, sample)].tolist()]
+
+    trials = []
+    for ef in sorted(c for c in candidates if c >= k) or [k]:
+        index.set_ef(ef)
+        found = 0
+        start = time.perf_counter()
+        for qid, query, expected in zip(ids[sample].tolist(), queries, truth):
+            hits = [eid for eid, _ in index.search_knn(query, k + 1) if eid != qid][:k]
+            found += len(expected.intersection(hits))
+        elapsed = time.perf_counter() - start
+
+        trial = EfTrial(ef=ef, recall=found / (k * len(sample)), latency_ms=1000 * elapsed / len(sample))
+        logger.debug(f"ef={trial.ef}: recall@{k}={trial.recall:.3f}, {trial.latency_ms:.3f} ms/query")
+        trials.append(trial)
+        if trial.recall >= target_recall:
+            break
+
+    best = trials[-1] if trials[-1].recall >= target_recall else max(trials, key=lambda t: t.recall)
+    met = best.recall >= target_recall
+    if not met:
+        logger.warning(f"No ef reached recall@{k} {target_recall}; using ef={best.ef} (recall {best.recall:.3f})")
+    index.set_ef(best.ef)
+    return EfTuning(ef=best.ef, target_recall=target_recall, met_target=met, trials=trials)
@@ -1,6 +1,7 @@
 import time
 import logging
 import sys
+import hashlib
 
 logger = logging.getLogger(__name__)
 
@@ -8,6 +9,10 @@ def get_unix_seconds() -> int:
     return int(time.time())
 
 
+def get_unix_time() -> float:
+    return time.time()
+
+
 def setup_logging(log_level: str) -> None:
     """
     Configure the root logger:
@@ -26,4 +31,12 @@ def setup_logging(log_level: str) -> None:
         stream=sys.stdout,
         format="%(asctime)s %(levelname)-8s [%(name)s] %(message)s",
         force=True,
-    )
\ No newline at end of file
+    )
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_file(path: str) -> str:
+    with open(path, "rb") as f:
+        return hash_bytes(f.read())